@@ -0,0 +1,78 @@
+"""
+Benchmarks describe_instances pagination against a stubbed EC2 client.
+
+Run with: python -m benchmarks.describe_instances
+
+"""
+
+from __future__ import print_function
+
+import time
+
+from botocore.exceptions import ClientError
+
+from ssha import config, ec2
+
+
+# Simulated API latency, scaled down to keep the benchmark quick.
+REQUEST_SECONDS = 0.015
+INSTANCE_SECONDS = 0.00003
+
+
+class StubEC2(object):
+
+    def __init__(self, count, throttle_every=None):
+        self.instances = [{'InstanceId': 'i-{:08x}'.format(index)} for index in range(count)]
+        self.throttle_every = throttle_every
+        self.requests = 0
+
+    def describe_instances(self, MaxResults, NextToken=None, Filters=None):
+        self.requests += 1
+        if self.throttle_every and self.requests % self.throttle_every == 0:
+            raise ClientError({'Error': {'Code': 'RequestLimitExceeded'}}, 'DescribeInstances')
+
+        start = int(NextToken or 0)
+        end = start + MaxResults
+        instances = self.instances[start:end]
+        time.sleep(REQUEST_SECONDS + INSTANCE_SECONDS * len(instances))
+
+        page = {
+            'ResponseMetadata': {'HTTPStatusCode': 200},
+            'Reservations': [{'Instances': instances}],
+        }
+        if end < len(self.instances):
+            page['NextToken'] = str(end)
+        return page
+
+
+def run(count, page_size=None, adaptive=False, throttle_every=None):
+    config.reset()
+    if page_size:
+        config.add('ec2.page_size', page_size)
+    if adaptive:
+        config.add('ec2.adaptive_page_size', True)
+
+    client = StubEC2(count, throttle_every=throttle_every)
+    start = time.time()
+    instances = list(ec2._describe_instances(client, filters={}))
+    seconds = time.time() - start
+    assert len(instances) == count
+    return client.requests, seconds
+
+
+def main():
+    modes = (
+        ('page size 15', {'page_size': 15}),
+        ('default', {}),
+        ('adaptive', {'adaptive': True}),
+        ('adaptive, throttled', {'adaptive': True, 'throttle_every': 4}),
+    )
+    print('{:>9}  {:<20}  {:>8}  {:>8}'.format('instances', 'mode', 'requests', 'seconds'))
+    for count in (100, 1000, 10000):
+        for name, kwargs in modes:
+            requests, seconds = run(count, **kwargs)
+            print('{:>9}  {:<20}  {:>8}  {:>8.3f}'.format(count, name, requests, seconds))
+
+
+if __name__ == '__main__':
+    main()
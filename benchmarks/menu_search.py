@@ -0,0 +1,108 @@
+"""
+Benchmarks filtering the menu as a search string is typed, and exits
+with an error if a keystroke takes longer than the budget.
+
+Run with: python -m benchmarks.menu_search
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import sys
+import time
+
+from ssha import menu
+
+
+# Visible rows in a typical terminal.
+ROWS = 50
+
+# Searches, typed one character at a time, then deleted.
+QUERIES = (
+    'prod-web-1234',
+    'pw1234',
+    'i-00001f',
+    'zzz',
+)
+
+
+def make_items(count):
+    environments = ('prod', 'stage', 'dev')
+    roles = ('web', 'worker', 'db', 'cache', 'bastion')
+    items = []
+    for index in range(count):
+        label = 'i-{:08x}  {}-{}-{}  10.{}.{}.{}'.format(
+            index,
+            environments[index % 3],
+            roles[index % 5],
+            index,
+            index // 65536, index // 256 % 256, index % 256,
+        )
+        items.append(menu.Item(label=label, value=index))
+    return items
+
+
+def keystroke(search, query):
+    """
+    Filters the items and formats the visible rows,
+    as the menu does after each keystroke.
+
+    """
+
+    items = search.filter(query)
+    return [item.label.ljust(120)[:120] for item in items[:ROWS]]
+
+
+def type_query(items, query):
+    """
+    Returns the seconds taken by each keystroke when typing
+    a query and then deleting it, starting with a new index.
+
+    """
+
+    search = menu.Search(items)
+    queries = [query[:length] for length in range(1, len(query) + 1)]
+    queries += list(reversed(queries[:-1])) + ['']
+
+    timings = []
+    for partial in queries:
+        start = time.time()
+        keystroke(search, partial)
+        timings.append(time.time() - start)
+    return timings
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--budget', type=float, default=0.016, help='Seconds per keystroke')
+    args = parser.parse_args()
+
+    items = make_items(args.count)
+
+    start = time.time()
+    menu.Search(items)
+    print('index {} items: {:.4f}s'.format(args.count, time.time() - start))
+
+    worst = 0
+    print('{:<16}  {:>10}  {:>10}  {:>10}'.format('query', 'first ms', 'mean ms', 'worst ms'))
+    for query in QUERIES:
+        timings = type_query(items, query)
+        worst = max(worst, max(timings))
+        print('{:<16}  {:>10.2f}  {:>10.2f}  {:>10.2f}'.format(
+            query,
+            timings[0] * 1000,
+            sum(timings) / len(timings) * 1000,
+            max(timings) * 1000,
+        ))
+
+    if worst > args.budget:
+        print('worst keystroke is over budget ({:.1f}ms)'.format(args.budget * 1000))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Benchmarks checking discover rules against many instances.
+
+Run with: python -m benchmarks.rules
+
+"""
+
+from __future__ import print_function
+
+import operator
+import time
+
+from ssha import ec2
+
+
+COUNT = 10000
+
+# Rules that the previous rule checker supported.
+RULES = {
+    'State': {'Name': 'running'},
+    'Tags': {'Environment': 'prod', 'Team': 'ops'},
+    'TagsNotEqual': {'Service': 'k8s'},
+}
+
+# Rules using every operator.
+OPERATOR_RULES = {
+    'State': {'Name': 'running'},
+    'TagsNotEqual': {'Service': 'k8s'},
+    'TagsPrefix': {'Name': 'web-'},
+    'TagsGlob': {'Owner': '*@example.com'},
+    'TagsRegex': {'Version': r'^1\.\d+$'},
+    'TagsIn': {'Environment': ['prod', 'stage']},
+    'TagsExists': {'Team': True},
+}
+
+
+def interpreted_rules_pass(obj, rules, compare=operator.eq):
+    """
+    The previous rule checker, which walked the rules for every instance.
+
+    """
+
+    for key, expected_value in rules.items():
+        if isinstance(expected_value, dict):
+            if key.endswith('NotEqual'):
+                nested_compare = operator.ne
+                key = key[:-len('NotEqual')]
+            else:
+                nested_compare = compare
+            if not interpreted_rules_pass(obj.get(key) or {}, expected_value, nested_compare):
+                return False
+        elif not compare(obj.get(key), expected_value):
+            return False
+    return True
+
+
+def make_instances(count):
+    instances = []
+    for index in range(count):
+        instances.append({
+            'InstanceId': 'i-{:08x}'.format(index),
+            'State': {'Name': 'running' if index % 10 else 'stopped'},
+            'Tags': {
+                'Environment': ('prod', 'stage', 'dev')[index % 3],
+                'Name': 'web-{}'.format(index),
+                'Owner': 'user{}@example.com'.format(index % 7),
+                'Service': ('web', 'k8s')[index % 2],
+                'Team': 'ops',
+                'Version': '1.{}'.format(index % 20),
+            },
+        })
+    return instances
+
+
+def timed(func):
+    start = time.time()
+    result = func()
+    return result, time.time() - start
+
+
+def main():
+    instances = make_instances(COUNT)
+
+    expected, interpreted_seconds = timed(
+        lambda: [instance for instance in instances if interpreted_rules_pass(instance, RULES)]
+    )
+    ec2._compiled_rules.clear()
+    result, compiled_seconds = timed(lambda: ec2._filter_instances(instances, RULES))
+    assert result == expected
+    _, operators_seconds = timed(lambda: ec2._filter_instances(instances, OPERATOR_RULES))
+
+    # Choosing which instances to look up in SSM checks
+    # several rule sets, as listing each region does.
+    ssm_rule_sets = [RULES, OPERATOR_RULES]
+    expected, per_call_seconds = timed(lambda: [
+        instance['InstanceId'] for instance in instances
+        if any(ec2._rules_pass(instance, rules) for rules in ssm_rule_sets)
+    ])
+    result, ssm_seconds = timed(lambda: ec2._ssm_candidates(instances, ssm_rule_sets))
+    assert result == expected
+
+    print('{:<24}  {:>9}  {:>13}'.format('rules', 'seconds', 'us/instance'))
+    for name, seconds in (
+        ('interpreted', interpreted_seconds),
+        ('compiled', compiled_seconds),
+        ('compiled, all operators', operators_seconds),
+        ('ssm, looked up per call', per_call_seconds),
+        ('ssm, compiled once', ssm_seconds),
+    ):
+        print('{:<24}  {:>9.4f}  {:>13.2f}'.format(name, seconds, seconds / COUNT * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Benchmarks parsing and looking up a large generated SSH config.
+
+Run with: python -m benchmarks.ssh_config
+
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import time
+
+from ssha import config, settings, ssh_config
+
+
+HOSTS = 2000
+INCLUDED_FILES = 20
+LOOKUPS = 1000
+
+
+def write_config(directory):
+    include_dir = os.path.join(directory, 'config.d')
+    os.mkdir(include_dir)
+
+    for file_index in range(INCLUDED_FILES):
+        path = os.path.join(include_dir, '{:02d}.conf'.format(file_index))
+        with open(path, 'w') as open_file:
+            for index in range(file_index, HOSTS, INCLUDED_FILES):
+                open_file.write('Host host-{0}.example.com host-{0}\n'.format(index))
+                open_file.write('  User user-{}\n'.format(index))
+                open_file.write('  IdentityFile ~/.ssh/key-{}\n\n'.format(index))
+            open_file.write('Host *.group-{}.example.com\n  Port 2222\n\n'.format(file_index))
+
+    path = os.path.join(directory, 'config')
+    with open(path, 'w') as open_file:
+        open_file.write('Include {}/*.conf\n\n'.format(include_dir))
+        open_file.write('Host *\n  User default\n  IdentityFile ~/.ssh/id_rsa\n')
+    return path
+
+
+def timed(func, repeat=1):
+    start = time.time()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.time() - start) / repeat
+
+
+def main():
+    settings.reset()
+    config.reset()
+
+    directory = tempfile.mkdtemp()
+    environ = dict(os.environ)
+    os.environ['XDG_CACHE_HOME'] = os.path.join(directory, 'cache')
+    try:
+        path = write_config(directory)
+        hostnames = ['host-{}.example.com'.format(index * 7 % HOSTS) for index in range(LOOKUPS)]
+
+        _, parse_seconds = timed(lambda: ssh_config.parse(path), repeat=5)
+        _, cold_seconds = timed(lambda: ssh_config.load(path))
+        parsed, warm_seconds = timed(lambda: ssh_config.load(path), repeat=5)
+        _, lookup_seconds = timed(lambda: [parsed.lookup(hostname) for hostname in hostnames])
+
+        print('{:<28}  {:>8}'.format('operation', 'seconds'))
+        print('{:<28}  {:>8.4f}'.format('parse', parse_seconds))
+        print('{:<28}  {:>8.4f}'.format('load (cold cache)', cold_seconds))
+        print('{:<28}  {:>8.4f}'.format('load (warm cache)', warm_seconds))
+        print('{:<28}  {:>8.6f}'.format('lookup', lookup_seconds / LOOKUPS))
+
+        try:
+            import paramiko
+        except ImportError:
+            return
+
+        # Paramiko does not support Include, so give it the hosts in one file.
+        combined_path = os.path.join(directory, 'combined')
+        with open(combined_path, 'w') as combined_file:
+            for name in sorted(os.listdir(os.path.join(directory, 'config.d'))):
+                with open(os.path.join(directory, 'config.d', name)) as open_file:
+                    combined_file.write(open_file.read())
+
+        def paramiko_parse():
+            paramiko_config = paramiko.SSHConfig()
+            with open(combined_path) as open_file:
+                paramiko_config.parse(open_file)
+            return paramiko_config
+
+        paramiko_config, paramiko_seconds = timed(paramiko_parse)
+        _, paramiko_lookup_seconds = timed(lambda: [paramiko_config.lookup(hostname) for hostname in hostnames])
+        print('{:<28}  {:>8.4f}'.format('paramiko parse', paramiko_seconds))
+        print('{:<28}  {:>8.6f}'.format('paramiko lookup', paramiko_lookup_seconds / LOOKUPS))
+
+    finally:
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+"""
+Benchmarks ssha startup time, and exits with an error if it is over budget.
+
+Run with: python -m benchmarks.startup
+
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from ssha import cache, config, ec2, settings
+
+
+SETTINGS = '''
+ssha {
+  configs = ["dev"]
+}
+
+aws {
+  region_name = "eu-west-1"
+}
+
+discover {
+  ec2 {
+    State {
+      Name = "running"
+    }
+  }
+}
+'''
+
+# Runs ssha with the menu replaced, so it exits when the menu would
+# be displayed, and reports whether boto was imported to get there.
+MENU_SCRIPT = '''
+import sys
+from ssha import cli, menu
+menu.choose_instance = lambda *args, **kwargs: None
+sys.argv = ['ssha', '--settings', sys.argv[1], 'dev']
+cli.main()
+print('boto imported: {}'.format('botocore' in sys.modules))
+'''
+
+
+def best_time(command, runs, env=None):
+    """
+    Returns the fastest wall time of a command, and its output.
+
+    """
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT, env=env)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best, output.decode('utf-8')
+
+
+def import_time(runs):
+    """
+    Returns the cumulative import time of ssha.cli in seconds.
+
+    """
+    best = None
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, '-X', 'importtime', '-c', 'import ssha.cli'],
+            stderr=subprocess.STDOUT,
+        ).decode('utf-8')
+        match = re.search(r'\|\s*(\d+) \| ssha\.cli$', output, re.MULTILINE)
+        seconds = int(match.group(1)) / 1000000.0
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def menu_time(runs):
+    """
+    Returns the time from starting ssha to displaying the menu,
+    when the discovered instances are already cached.
+
+    """
+
+    temp_dir = tempfile.mkdtemp()
+    try:
+
+        settings_path = os.path.join(temp_dir, '.ssha')
+        with open(settings_path, 'w') as open_file:
+            open_file.write(SETTINGS)
+
+        env = dict(os.environ)
+        env['XDG_CACHE_HOME'] = os.path.join(temp_dir, 'cache')
+        os.environ['XDG_CACHE_HOME'] = env['XDG_CACHE_HOME']
+
+        settings.load(settings_path=settings_path)
+        config.load('dev')
+        region_name = config.get('aws.region_name')
+        cache_key = ec2._cache_key(region_name, ec2._listing_filters(), ec2._ssm_rule_sets())
+        instances = [{'InstanceId': 'i-{:08x}'.format(index), 'Region': region_name} for index in range(1000)]
+        cache.write('instances', cache_key, instances)
+
+        return best_time([sys.executable, '-c', MENU_SCRIPT, settings_path], runs, env=env)
+
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--import-budget', type=float, default=0.15, help='Seconds')
+    parser.add_argument('--menu-budget', type=float, default=0.5, help='Seconds')
+    args = parser.parse_args()
+
+    over_budget = False
+
+    seconds = import_time(args.runs)
+    print('import ssha.cli: {:.3f}s (budget {:.3f}s)'.format(seconds, args.import_budget))
+    over_budget |= seconds > args.import_budget
+
+    seconds, _ = best_time([sys.executable, '-m', 'ssha', '--version'], args.runs)
+    print('ssha --version: {:.3f}s'.format(seconds))
+
+    seconds, output = menu_time(args.runs)
+    print('start to menu with cached instances: {:.3f}s (budget {:.3f}s, {})'.format(
+        seconds, args.menu_budget, output.strip().splitlines()[-1],
+    ))
+    over_budget |= seconds > args.menu_budget
+
+    if over_budget:
+        print('startup time is over budget')
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
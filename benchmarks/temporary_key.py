@@ -0,0 +1,99 @@
+"""
+Benchmarks how long connecting waits for a temporary key, for each key
+type, with and without generating it in the background or using the pool.
+
+Run with: python -m benchmarks.temporary_key
+
+"""
+
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from ssha import config, keys, settings
+
+
+# Simulated time spent discovering instances and choosing one,
+# which background key generation overlaps with.
+DISCOVERY_SECONDS = 0.3
+
+REPEAT = 5
+
+
+def wait_for_key(key_type, background=False, pool_size=0):
+    """
+    Returns the number of seconds spent waiting for the key before connecting.
+
+    """
+
+    config.reset()
+
+    if background:
+        value = config._Deferred(keys.temporary_key, key_type, pool_size)
+        time.sleep(DISCOVERY_SECONDS)
+        waiting = time.time()
+        value.result()
+        return time.time() - waiting
+
+    start = time.time()
+    keys.temporary_key(key_type, pool_size)
+    return time.time() - start
+
+
+def main():
+    settings.reset()
+
+    temp_dir = tempfile.mkdtemp()
+    environ = dict(os.environ)
+    os.environ['XDG_CACHE_HOME'] = temp_dir
+
+    # Measure generating keys, not the SSH agent.
+    add_to_agent = keys.add_to_agent
+    keys.add_to_agent = lambda private_key: None
+
+    # Wait for pool refills to finish, so they don't slow down the next run.
+    start_thread = threading.Thread.start
+    threads = []
+
+    def record_start(thread):
+        threads.append(thread)
+        start_thread(thread)
+
+    threading.Thread.start = record_start
+
+    try:
+        print('{:<8}  {:<24}  {:>8}'.format('key', 'mode', 'seconds'))
+        for key_type in keys.key_types:
+            for name, kwargs in (
+                ('generate', {}),
+                ('generate in background', {'background': True}),
+                ('pool', {'pool_size': 1}),
+            ):
+                # Fill the pool before measuring, and wait for the
+                # refill so the first measured key comes from it.
+                if kwargs.get('pool_size'):
+                    keys.temporary_key(key_type, pool_size=1)
+                    for thread in threads:
+                        thread.join()
+                    del threads[:]
+                total = 0
+                for _ in range(REPEAT):
+                    total += wait_for_key(key_type, **kwargs)
+                    for thread in threads:
+                        thread.join()
+                    del threads[:]
+                print('{:<8}  {:<24}  {:>8.4f}'.format(key_type, name, total / REPEAT))
+    finally:
+        threading.Thread.start = start_thread
+        keys.add_to_agent = add_to_agent
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -24,7 +24,7 @@ setup(
         'botocore>=1.5.8',
         'boto3',
         'cryptography',
-        'paramiko',
+        'futures; python_version < "3"',
         'pyhcl',
     ),
 )
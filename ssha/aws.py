@@ -1,22 +1,34 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import boto_source_profile_mfa
-
-from botocore.exceptions import ClientError, ParamValidationError
+import json
+import os
+import threading
 
 from functools import wraps
 
-from . import config
+from . import cache, config
 
 
+_clients = {}
+_lock = threading.RLock()
 _sessions = {}
 
 
+def _session_config():
+    """
+    Returns the current aws config, and the key of its session.
+
+    """
+    aws_config = config.get('aws') or {}
+    return aws_config, json.dumps(aws_config, sort_keys=True)
+
+
 def retry(attempts=3):
     def wrapper(func):
         @wraps(func)
         def wrapped(*args, **kwargs):
+            from botocore.exceptions import ClientError, ParamValidationError
             tries = attempts
             while True:
                 tries -= 1
@@ -33,19 +45,69 @@ def retry(attempts=3):
 
 @retry()
 def client(*args, **kwargs):
-    return session().client(*args, **kwargs)
+    """
+    Returns a client for the current aws config. Clients are reused
+    for the lifetime of the process and can be shared between threads.
+
+    """
+    _, session_key = _session_config()
+    key = (session_key, 'client', args, json.dumps(kwargs, sort_keys=True))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session().client(*args, **kwargs)
+        return _clients[key]
 
 
 @retry()
 def credentials(*args, **kwargs):
-    return session().get_credentials(*args, **kwargs)
+    with _lock:
+        return session().get_credentials(*args, **kwargs)
 
 
 @retry()
 def resource(*args, **kwargs):
-    return session().resource(*args, **kwargs)
+    _, session_key = _session_config()
+    key = (session_key, 'resource', args, json.dumps(kwargs, sort_keys=True))
+    with _lock:
+        if key not in _clients:
+            _clients[key] = session().resource(*args, **kwargs)
+        return _clients[key]
+
+
+def profile():
+    """
+    Returns the configured profile and the environment variables that
+    choose the AWS account, for keeping cached values per account.
+    This does not import boto, so it can be used for cache lookups.
+
+    """
+
+    return [
+        config.get('aws.profile_name'),
+        os.environ.get('AWS_PROFILE'),
+        os.environ.get('AWS_DEFAULT_PROFILE'),
+        os.environ.get('AWS_ACCESS_KEY_ID'),
+    ]
+
+
+def reset():
+    with _lock:
+        _clients.clear()
+        _sessions.clear()
 
 
 def session():
-    aws_config = config.get('aws') or {}
-    return boto_source_profile_mfa.get_session(**aws_config)
+    """
+    Returns a session for the current aws config. Sessions are reused
+    so that credentials are only resolved once per profile and region.
+
+    """
+    aws_config, key = _session_config()
+    with _lock:
+        if key not in _sessions:
+            import boto_source_profile_mfa
+            _sessions[key] = boto_source_profile_mfa.get_session(**aws_config)
+            if cache.enabled():
+                from . import credential_cache
+                credential_cache.install(_sessions[key], aws_config)
+        return _sessions[key]
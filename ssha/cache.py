@@ -0,0 +1,181 @@
+from __future__ import unicode_literals
+
+import datetime
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+from . import config
+
+
+# How old partly written files must be before clean removes them.
+_temp_file_ttl = 60
+
+
+def _decode(data):
+    if '__datetime__' in data:
+        from dateutil.parser import parse
+        return parse(data['__datetime__'])
+    return data
+
+
+def _encode(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError('Cannot cache {!r}'.format(value))
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as error:
+        if error.errno != errno.EEXIST:
+            raise
+
+
+def _path(namespace, key):
+    return os.path.join(directory(), namespace, key + '.json')
+
+
+def clean(namespace, max_age=_temp_file_ttl):
+    """
+    Removes partly written and partly taken files from a namespace that
+    are older than max_age seconds. These are left behind if a run exits
+    while writing or taking a value, such as from a daemon thread. Newer
+    files are left alone, as concurrent runs could still be using them.
+
+    """
+
+    path = os.path.join(directory(), namespace)
+    try:
+        filenames = os.listdir(path)
+    except OSError:
+        return
+
+    for filename in filenames:
+        if filename.endswith('.tmp') or '.json.taken.' in filename:
+            file_path = os.path.join(path, filename)
+            try:
+                if time.time() - os.path.getmtime(file_path) > max_age:
+                    os.remove(file_path)
+            except OSError:
+                pass
+
+
+def delete(namespace, key):
+    try:
+        os.remove(_path(namespace, key))
+    except OSError:
+        pass
+
+
+def directory():
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'ssha')
+
+
+def enabled():
+    return not config.get('cache.disabled')
+
+
+def key(*parts):
+    """
+    Returns a cache key for the given values.
+
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def names(namespace):
+    """
+    Returns the keys of the values cached in a namespace.
+
+    """
+
+    if not enabled():
+        return []
+
+    try:
+        filenames = os.listdir(os.path.join(directory(), namespace))
+    except OSError:
+        return []
+
+    return sorted(filename[:-len('.json')] for filename in filenames if filename.endswith('.json'))
+
+
+def read(namespace, key):
+    """
+    Returns a tuple of (value, age in seconds) for a cached value,
+    or (None, None) if it has not been cached.
+
+    """
+
+    if not enabled():
+        return None, None
+
+    try:
+        with open(_path(namespace, key)) as open_file:
+            data = json.load(open_file, object_hook=_decode)
+    except (IOError, OSError, ValueError):
+        return None, None
+
+    age = max(time.time() - data['time'], 0)
+    return data['value'], age
+
+
+def take(namespace, key):
+    """
+    Removes a cached value and returns a tuple of (value, age in seconds),
+    or (None, None) if it has not been cached. When concurrent runs take
+    the same value, only one of them gets it.
+
+    """
+
+    if not enabled():
+        return None, None
+
+    path = _path(namespace, key)
+    taken_path = path + '.taken.{}'.format(os.getpid())
+    try:
+        os.rename(path, taken_path)
+    except OSError:
+        return None, None
+
+    try:
+        with open(taken_path) as open_file:
+            data = json.load(open_file, object_hook=_decode)
+    except (IOError, OSError, ValueError):
+        return None, None
+    finally:
+        os.remove(taken_path)
+
+    age = max(time.time() - data['time'], 0)
+    return data['value'], age
+
+
+def write(namespace, key, value):
+    """
+    Writes a value to the cache. Files are only readable by the current
+    user and are replaced atomically so concurrent runs never see partial
+    files.
+
+    """
+
+    if not enabled():
+        return
+
+    path = _path(namespace, key)
+    _makedirs(os.path.dirname(path))
+
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as open_file:
+            json.dump({'time': time.time(), 'value': value}, open_file, default=_encode)
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
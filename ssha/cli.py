@@ -2,7 +2,174 @@ from __future__ import print_function
 
 import argparse
 
-from . import __version__, config, ec2, menu, settings, ssm, ssh
+from . import __version__, config, ec2, menu, settings, ssm, ssh, tasks
+
+
+def _explain_config():
+    """
+    Prints each variable used in the config, with its
+    value and the keys that use it.
+
+    """
+
+    for variable, names in sorted(config.variables().items()):
+        try:
+            value = config.get(variable)
+        except KeyError as error:
+            value = '(uses {}, which is not set)'.format(error.args[0])
+        if value is None:
+            value = '(not set)'
+        print('${{{}}} = {}'.format(variable, value))
+        for name in names:
+            print('  used by {}'.format(name))
+
+
+def _check_logins(connections, max_workers):
+    """
+    Checks that ssh can log in to instances, several at a time, and
+    returns the connections that it can't log in to.
+
+    """
+
+    import concurrent.futures
+
+    ssh_commands = []
+    for instance, bastion in connections:
+        config.add('aws.region_name', instance['Region'])
+        ssh_commands.append(ssh.prepare_check(instance, bastion))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(ssh_commands))) as executor:
+        results = list(executor.map(ssh.run_check, ssh_commands))
+
+    return [connection for connection, logged_in in zip(connections, results) if not logged_in]
+
+
+def _send_commands(connections, forget=False):
+    """
+    Runs the SSM document on instances, one region at a time, and
+    returns the IDs of the instances it was skipped on. If forget is
+    set, the document is run even if it was run recently.
+
+    """
+
+    skipped = set()
+    for region_name in sorted(set(instance['Region'] for instance, _ in connections)):
+        config.add('aws.region_name', region_name)
+        region_connections = [
+            (instance, bastion) for instance, bastion in connections if instance['Region'] == region_name
+        ]
+        if forget:
+            ssm.forget_provisioned([instance['InstanceId'] for instance, _ in region_connections])
+        skipped.update(ssm.send_commands(region_connections))
+    return skipped
+
+
+def _run_all(instances, command, max_workers):
+    """
+    Runs a command on every instance. The commands are prepared one at a
+    time, because that uses the global config, then run concurrently.
+
+    """
+
+    from . import fanout
+
+    if not instances:
+        print('[ssha] no matching instances found')
+        return 0
+
+    connections = []
+    for instance in instances:
+        config.add('aws.region_name', instance['Region'])
+        if config.get('bastion') and not config.get('bastion.disabled'):
+            bastion = ec2.discover_bastion(instance)
+        else:
+            bastion = None
+        connections.append((instance, bastion))
+
+    if config.get('ssm.document'):
+        skipped = _send_commands(connections)
+        if skipped:
+            failed = _check_logins([
+                (instance, bastion) for instance, bastion in connections if instance['InstanceId'] in skipped
+            ], max_workers)
+            if failed:
+                # The SSM document was not run on these because it had been
+                # run recently, but ssh can't log in, so run it again.
+                print('[ssha] ssh failed on {} instances, running the ssm document again'.format(len(failed)))
+                _send_commands(failed, forget=True)
+
+    commands = []
+    for instance, bastion in connections:
+        config.add('aws.region_name', instance['Region'])
+        ssh.prepare(instance, bastion)
+        commands.append((instance['InstanceId'], config.render(command)))
+
+    results = fanout.run(commands, max_workers=min(max_workers, len(commands)))
+
+    return 1 if any(exit_code for exit_code, _ in results) else 0
+
+
+def _startup(args):
+    """
+    Loads the config and discovers instances. Phases that don't depend
+    on each other run concurrently, while anything that can prompt the
+    user runs in the main thread. Returns the discovered instances, or
+    None if there is nothing else to do.
+
+    """
+
+    graph = tasks.Graph()
+
+    try:
+
+        graph.run('settings', settings.load, settings_path=args.settings, verbose=args.verbose, refresh=args.refresh)
+
+        config_name = menu.choose_config(config.names(), args.config)
+        graph.run('config', config.load_settings, config_name, deps=('settings',))
+
+        graph.submit('ssh_config', config.load_ssh_config, deps=('config',))
+
+        # Group settings can change anything, including the regions shown
+        # next, so everything after this waits for them. Looking up groups
+        # can prompt for an MFA token, so it runs in the main thread.
+        after = ('config',)
+        if config.get('iam.group'):
+            graph.run('iam', config.load_iam_groups, deps=after)
+            after = ('iam',)
+        else:
+            graph.skip('iam', 'no iam group settings')
+
+        if args.all_regions:
+            # The option overrides a region set in the config.
+            config.add('discover.all_regions', True)
+            config.add('aws.region_name', None)
+
+        if args.region or not config.get('discover.all_regions'):
+            regions = config.regions()
+            region_name = menu.choose_config(regions, args.region)
+            if region_name:
+                config.add('aws.region_name', region_name)
+
+        graph.submit('defaults', config.load_defaults, deps=after + ('ssh_config',))
+
+        if args.explain_config:
+            graph.result('defaults')
+            _explain_config()
+            return None
+
+        # Listing starts in the main thread, in case of an MFA prompt,
+        # then the API calls run in the background along with the rest
+        # of the config.
+        graph.run('listing', ec2.start_discovery, wait=bool(args.command), deps=after)
+        instances = graph.run('discovery', ec2.discover_instances, wait=bool(args.command), deps=('listing',))
+        graph.result('defaults')
+
+    finally:
+        graph.shutdown()
+        if args.trace:
+            graph.trace()
+
+    return instances
 
 
 def main():
@@ -12,32 +179,52 @@ def main():
         parser.add_argument('config', nargs='?', help='Configuration name')
         parser.add_argument('search', nargs='?', help='Instance search string')
         parser.add_argument('-v', '--verbose', action='store_true', help='Verbose mode')
+        parser.add_argument('--all', action='store_true', help='Run --command on every matching instance')
+        parser.add_argument('--all-regions', action='store_true', help='Discover instances in all regions')
         parser.add_argument('--command', help='Command to run instead of ssh')
+        parser.add_argument('--explain-config', action='store_true', help='show the config variables and exit')
+        parser.add_argument(
+            '--refresh', action='store_true', help='Ignore cached instances, IAM groups and bastion probes',
+        )
         parser.add_argument('--region', help='Region name')
         parser.add_argument('--settings', help='Path to the .ssha file')
+        parser.add_argument('--trace', action='store_true', help='show how long each startup phase took')
         parser.add_argument('--version', action='store_true', help='show the installed version and exit')
+        parser.add_argument('--workers', type=int, default=10, help='Number of instances to run --command on at once')
 
         args = parser.parse_args()
 
+        if args.all and not args.command:
+            parser.error('--all requires --command')
+        if args.workers < 1:
+            parser.error('--workers must be at least 1')
+        if args.all_regions and args.region:
+            parser.error('--all-regions and --region cannot be used together')
+
         if args.version:
             print(__version__)
             return 0
 
-        settings.load(settings_path=args.settings, verbose=args.verbose)
-
-        configs = config.names()
-        config_name = menu.choose_config(configs, args.config)
-        config.load(config_name)
+        instances = _startup(args)
+        if instances is None:
+            return 0
 
-        regions = config.regions()
-        region_name = menu.choose_config(regions, args.region)
-        if region_name:
-            config.add('aws.region_name', region_name)
+        if args.all:
+            return _run_all(menu.matching_instances(instances, args.search), args.command, args.workers)
 
-        instances = ec2.discover_instances()
-        instance = menu.choose_instance(instances, args.search, show_menu=not args.command)
+        instance = menu.choose_instance(
+            instances,
+            args.search,
+            show_menu=not args.command,
+            refresh=ec2.refreshed_instances,
+            refreshing=ec2.refreshing,
+        )
         if instance:
 
+            # Use the instance's region for everything else,
+            # in case instances were discovered in all regions.
+            config.add('aws.region_name', instance['Region'])
+
             if not args.command and ssm.session_manager_enabled(instance):
 
                 return ssm.start_session(instance)
@@ -49,10 +236,22 @@ def main():
                 else:
                     bastion = None
 
+                skipped = []
                 if config.get('ssm.document'):
+                    skipped = ssm.send_command(instance, bastion)
+
+                if skipped and not ssh.check(instance, bastion):
+                    # The SSM document was not run because it had been run
+                    # recently, but ssh can't log in, so run it again. This
+                    # is checked first, rather than retrying after a failure,
+                    # because ssh also fails when commands and sessions do.
+                    print('[ssha] ssh failed, running the ssm document again')
+                    ssm.forget_provisioned(skipped)
                     ssm.send_command(instance, bastion)
 
-                return ssh.connect(instance, bastion, args.command)
+                exit_code = ssh.connect(instance, bastion, args.command)
+
+                return exit_code
 
         else:
             print('[ssha] no matching instances found')
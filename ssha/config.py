@@ -5,12 +5,9 @@ import os
 import re
 import subprocess
 import tempfile
+import threading
 
-from cryptography.hazmat.primitives import serialization as crypto_serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.hazmat.backends import default_backend as crypto_default_backend
 from fnmatch import fnmatch
-from paramiko.config import SSHConfig
 
 from . import errors, settings
 
@@ -20,13 +17,88 @@ except NameError:
     basestring = str
 
 
+_commands = {}
 _config = {}
+_lock = threading.RLock()
+_parsed_ssh_config = {}
+_parsed_ssh_config_lock = threading.Lock()
+_references = {}
+_rendered = {}
 _ssh_config = {}
+_templates = {}
 _tempfiles = {}
+_used_by = {}
+
+# Incremented whenever the config changes, so that values rendered
+# from an older config are not remembered.
+_generation = 0
+
+# Returned by dict.get for keys without a value.
+_missing = object()
+
+# Matches variables like ${ssh.username} in config strings.
+_variable_pattern = re.compile(r'\$\{(.+?)\}')
+
+
+class _Deferred(object):
+    """
+    A config value that is computed in a background thread.
+    Getting the value waits for it to be ready.
+
+    """
+
+    def __init__(self, func, *args):
+        self._done = threading.Event()
+        self._error = None
+        self._value = None
+        thread = threading.Thread(target=self._run, args=(func, args))
+        thread.daemon = True
+        thread.start()
+
+    def __deepcopy__(self, memo):
+        # Copies are made while holding the config lock, so don't wait
+        # for the value here. Rendering waits for it instead.
+        return self
+
+    def _run(self, func, args):
+        try:
+            self._value = func(*args)
+        except Exception as error:
+            self._error = error
+        finally:
+            self._done.set()
+
+    def result(self):
+        self._done.wait()
+        if self._error is not None:
+            errors.string_exit(str(self._error))
+        return self._value
+
+
+def _compile(template):
+    """
+    Splits a config string into a tuple of alternating text and variable
+    names, so that rendering it again does not need to scan the string.
+
+    """
+
+    tokens = _templates.get(template)
+    if tokens is None:
+        tokens = _templates[template] = tuple(_variable_pattern.split(template))
+    return tokens
 
 
 def _exec(command):
-    return subprocess.check_output(command, shell=True).strip().decode('utf-8')
+    """
+    Runs a shell command and returns its output. Each command
+    only runs once, and the output is reused after that.
+
+    """
+
+    with _lock:
+        if command not in _commands:
+            _commands[command] = subprocess.check_output(command, shell=True).strip().decode('utf-8')
+        return _commands[command]
 
 
 def _get(key, default=None):
@@ -35,25 +107,22 @@ def _get(key, default=None):
         value = value.get(key)
         if not value:
             break
+    if isinstance(value, _Deferred):
+        value = value.result()
     return value or default
 
 
 def _get_ssh_config(key):
     if not _ssh_config:
 
-        ssh_config = SSHConfig()
-
-        path = os.path.expanduser('~/.ssh/config')
-        if os.path.exists(path):
-            with open(path) as open_file:
-                ssh_config.parse(open_file)
+        parsed_ssh_config = load_ssh_config()
 
         # Create a fake hostname like "dev.myproject.ssha" to allow users to
         # set options in ~/.ssh/config based on the environment and project.
         hostname_parts = (get('config.name'), get('ssha.name'), 'ssha')
         hostname = '.'.join(filter(None, hostname_parts))
 
-        result = ssh_config.lookup(hostname)
+        result = parsed_ssh_config.lookup(hostname)
 
         if 'identityfile' not in result:
             result['identityfile'] = [
@@ -73,35 +142,140 @@ def _get_ssh_config(key):
     return _ssh_config.get(key, [])
 
 
-def _is_used(data, key):
+def _index(path, value):
     """
-    Checks if a key is used as a variable anywhere else in the config.
+    Adds the variables used by a value to the reference index.
 
     """
-    if isinstance(data, basestring):
-        for var in re.findall(r'\$\{(.+?)\}', data):
-            if var == key:
-                return True
-    elif isinstance(data, dict):
-        for value in data.values():
-            if _is_used(value, key):
-                return True
-    elif isinstance(data, list):
-        for value in data:
-            if _is_used(value, key):
-                return True
-    return False
 
+    if isinstance(value, dict):
+        for key, nested_value in value.items():
+            _index(path + (key,), nested_value)
+    else:
+        variables = _variables(value)
+        if variables:
+            name = '.'.join(path)
+            _references[name] = variables
+            for variable in variables:
+                _used_by.setdefault(variable, set()).add(name)
 
-def _merge(target, source):
+
+def _merge(target, source, path=()):
     for key in source:
         if key in target:
             if isinstance(target[key], dict) and isinstance(source[key], dict):
-                _merge(target[key], source[key])
+                _merge(target[key], source[key], path + (key,))
             else:
+                _unindex(path + (key,))
                 target[key] = source[key]
+                _index(path + (key,), source[key])
         else:
             target[key] = source[key]
+            _index(path + (key,), source[key])
+
+
+def _pop(key):
+    """
+    Removes a top-level key from the config and returns its value.
+
+    """
+
+    global _generation
+    with _lock:
+        _unindex((key,))
+        _generation += 1
+        _rendered.clear()
+        return _config.pop(key, None)
+
+
+def _render(data, resolving):
+    if isinstance(data, _Deferred):
+        data = data.result()
+    if isinstance(data, basestring):
+        if '${' in data:
+            tokens = _compile(data)
+            parts = list(tokens)
+            for index in range(1, len(tokens), 2):
+                value = _resolve(tokens[index], resolving)
+                if value is None:
+                    raise KeyError(tokens[index])
+                parts[index] = value
+            data = ''.join(parts)
+        if data.startswith('$(') and data.endswith(')'):
+            data = _exec(data[2:-1])
+    elif isinstance(data, dict):
+        for key, value in data.items():
+            data[key] = _render(value, resolving)
+    elif isinstance(data, list):
+        data = [_render(item, resolving) for item in data]
+    return data
+
+
+def _resolve(key, resolving=()):
+    """
+    Returns the rendered value of a key, or None if it is not set.
+    Rendered values are remembered until the config is updated.
+
+    """
+
+    value = _rendered.get(key, _missing)
+    if value is not _missing:
+        return value
+
+    generation = _generation
+    value = _get(key)
+    if not value:
+        return value
+
+    if key in resolving:
+        cycle = resolving[resolving.index(key):] + (key,)
+        errors.string_exit('Config variables reference each other: ' + ' -> '.join(cycle))
+
+    if isinstance(value, (dict, list)):
+        with _lock:
+            value = copy.deepcopy(value)
+
+    value = _render(value, resolving + (key,))
+    with _lock:
+        if generation == _generation:
+            _rendered[key] = value
+    return value
+
+
+def _unindex(path):
+    """
+    Removes the variables used by a key, and any keys
+    nested inside of it, from the reference index.
+
+    """
+
+    name = '.'.join(path)
+    prefix = name + '.'
+    for reference in list(_references):
+        if reference == name or reference.startswith(prefix):
+            for variable in _references.pop(reference):
+                _used_by[variable].discard(reference)
+                if not _used_by[variable]:
+                    del _used_by[variable]
+
+
+def _variables(data):
+    """
+    Returns the variable names used in a value.
+
+    """
+
+    result = set()
+    if isinstance(data, basestring):
+        if '${' in data:
+            result.update(_compile(data)[1::2])
+    elif isinstance(data, dict):
+        for value in data.values():
+            result.update(_variables(value))
+    elif isinstance(data, list):
+        for value in data:
+            result.update(_variables(value))
+    return result
 
 
 def add(name, value):
@@ -117,69 +291,40 @@ def add(name, value):
 
 def get(key, default=None):
 
-    value = _get(key, default)
+    if not _get(key):
+        if not default:
+            return default
+        return render(copy.deepcopy(default))
 
-    if not value:
-        return value
+    value = _resolve(key)
 
+    # Callers may change the value, so don't return the remembered one.
     if isinstance(value, (dict, list)):
         value = copy.deepcopy(value)
 
-    return render(value)
+    return value
 
 
-def generate_key():
+def load(name):
     """
-    Generates and adds a key to the SSH agent.
+    Loads a config from the settings. This runs each of the load phases
+    in order, while the command line runs them concurrently when it can.
 
     """
-    key = rsa.generate_private_key(
-        backend=crypto_default_backend(),
-        public_exponent=65537,
-        key_size=4096,
-    )
-    private_key = key.private_bytes(
-        crypto_serialization.Encoding.PEM,
-        crypto_serialization.PrivateFormat.PKCS8,
-        crypto_serialization.NoEncryption(),
-    ).decode()
-    public_key = key.public_key().public_bytes(
-        crypto_serialization.Encoding.OpenSSH,
-        crypto_serialization.PublicFormat.OpenSSH,
-    ).decode()
-
-    with tempfile.NamedTemporaryFile(suffix='-ssha-temporary-key') as temp_key:
-        os.chmod(temp_key.name, 0o600)
-        with open(temp_key.name, 'w') as open_file:
-            open_file.write(private_key)
-        os.system('ssh-add -t 60 {}'.format(temp_key.name))
-
-    return public_key
 
+    load_settings(name)
+    load_iam_groups()
+    load_ssh_config()
+    load_defaults()
 
-def load(name):
-    """
-    Loads a config from the settings.
 
+def load_defaults():
     """
+    Sets config values that are based on the rest of the config,
+    such as the SSH username and temporary keys. Runs after the
+    settings and IAM group settings have been loaded.
 
-    update(settings.all())
-
-    config_specific_settings = _config.pop('config', None) or {}
-    if name:
-        if name not in names():
-            errors.string_exit('config {} not found in .ssha file'.format(name))
-        for config_name in config_specific_settings:
-            if fnmatch(name, config_name):
-                update(config_specific_settings[config_name])
-        add('config.name', name)
-
-    iam_group_specific_settings = get('iam.group')
-    if iam_group_specific_settings:
-        from . import iam
-        for group in iam.groups():
-            if group in iam_group_specific_settings:
-                update(iam_group_specific_settings[group])
+    """
 
     # Default to SSH's default user.
     if not _get('ssh.username'):
@@ -195,7 +340,8 @@ def load(name):
             known_hosts_options = ['-o', 'UserKnownHostsFile=${ssh.user_known_hosts_file}']
         else:
             known_hosts_options = []
-        proxy_command = ['ssh'] + known_hosts_options + ['-W', '%h:%p', '${bastion.address}']
+        control_options = ssh.control_options(proxy_command=True)
+        proxy_command = ['ssh'] + control_options + known_hosts_options + ['-W', '%h:%p', '${bastion.address}']
         add('ssh.proxy_command', ssh.format_command(proxy_command))
 
     # To support configs like this:
@@ -203,8 +349,15 @@ def load(name):
     # If "ssh.temporary_key" has been used as a variable, then
     # generate a temporary SSH key for use with the session and
     # load it into the SSH agent
+    # The key is generated in the background while instances are
+    # being discovered, and config.get waits for it when needed.
     if is_used_as_variable('ssh.temporary_key'):
-        add('ssh.temporary_key', generate_key())
+        from . import keys
+        key_type = get('ssh.temporary_key_type') or 'ed25519'
+        if key_type not in keys.key_types:
+            errors.string_exit('ssh.temporary_key_type must be one of: {}'.format(', '.join(keys.key_types)))
+        pool_size = get('ssh.temporary_key_pool') or 0
+        add('ssh.temporary_key', _Deferred(keys.temporary_key, key_type, pool_size))
 
     # To support configs like this:
     #   ssm.parameters.key = ["$(cat '${ssh.identityfile_public}')"]
@@ -240,6 +393,53 @@ def load(name):
         add('ssm.host_keys_file', _tempfiles['host_keys_file'].name)
 
 
+def load_iam_groups():
+    """
+    Applies the settings for the user's IAM groups. The groups are
+    cached on disk, so this only waits for AWS API calls the first time.
+
+    """
+
+    iam_group_specific_settings = get('iam.group')
+    if iam_group_specific_settings:
+        from . import iam
+        for group in iam.groups():
+            if group in iam_group_specific_settings:
+                update(iam_group_specific_settings[group])
+
+
+def load_settings(name):
+    """
+    Loads the settings, and the settings for the named config.
+
+    """
+
+    update(settings.all())
+
+    config_specific_settings = _pop('config') or {}
+    if name:
+        if name not in names():
+            errors.string_exit('config {} not found in .ssha file'.format(name))
+        for config_name in config_specific_settings:
+            if fnmatch(name, config_name):
+                update(config_specific_settings[config_name])
+        add('config.name', name)
+
+
+def load_ssh_config():
+    """
+    Returns the parsed ~/.ssh/config file, parsing it the first time.
+
+    """
+
+    with _parsed_ssh_config_lock:
+        if not _parsed_ssh_config:
+            from . import ssh_config
+            path = os.path.expanduser('~/.ssh/config')
+            _parsed_ssh_config['parsed'] = ssh_config.load(path)
+        return _parsed_ssh_config['parsed']
+
+
 def names():
     ssha_settings = settings.all().get('ssha') or {}
     return ssha_settings.get('configs') or []
@@ -253,31 +453,43 @@ def regions():
 
 
 def render(data):
-    if isinstance(data, basestring):
-        for var in re.findall(r'\$\{(.+?)\}', data):
-            value = get(var)
-            if value is None:
-                raise KeyError(var)
-            data = data.replace('${' + var + '}', value)
-        if data.startswith('$(') and data.endswith(')'):
-            data = _exec(data[2:-1])
-    elif isinstance(data, dict):
-        for key, value in data.items():
-            data[key] = render(value)
-    elif isinstance(data, list):
-        data = [render(item) for item in data]
-    return data
+    """
+    Replaces variables like ${ssh.username} with their values, and
+    values like $(command) with the output of the command.
+
+    """
+
+    return _render(data, resolving=())
 
 
 def reset():
+    _commands.clear()
     _config.clear()
+    _parsed_ssh_config.clear()
+    _references.clear()
+    _rendered.clear()
     _ssh_config.clear()
     _tempfiles.clear()
+    _used_by.clear()
 
 
 def update(data):
-    _merge(_config, data)
+    global _generation
+    with _lock:
+        _merge(_config, data)
+        _generation += 1
+        _rendered.clear()
 
 
 def is_used_as_variable(key):
-    return _is_used(_config, key)
+    return key in _used_by
+
+
+def variables():
+    """
+    Returns a dict of {variable: [keys]} for every variable
+    used in the config, with the keys that use it.
+
+    """
+
+    return dict((variable, sorted(names)) for variable, names in _used_by.items())
@@ -0,0 +1,117 @@
+from __future__ import unicode_literals
+
+import datetime
+import os
+
+from botocore.credentials import CredentialProvider, CredentialResolver, RefreshableCredentials
+from dateutil.parser import parse
+from dateutil.tz import tzutc
+
+from . import cache
+
+
+# Environment variables that botocore resolves credentials from.
+_environment_variables = (
+    'AWS_ACCESS_KEY_ID',
+    'AWS_CONTAINER_CREDENTIALS_FULL_URI',
+    'AWS_CONTAINER_CREDENTIALS_RELATIVE_URI',
+    'AWS_DEFAULT_PROFILE',
+    'AWS_PROFILE',
+    'AWS_ROLE_ARN',
+    'AWS_WEB_IDENTITY_TOKEN_FILE',
+)
+
+
+class CachedCredentialProvider(CredentialProvider):
+    """
+    Provides temporary credentials from the ssha cache, so that assumed
+    role and MFA sessions can be reused between runs without any STS calls.
+    Credentials are resolved with the other providers when they are missing
+    or close to expiring, and then written to the cache.
+
+    """
+
+    METHOD = 'ssha-cache'
+    CANONICAL_NAME = 'ssha-cache'
+
+    # Match the advisory refresh timeout of botocore's refreshable
+    # credentials, so cached credentials are not refreshed right away.
+    expiry_window = datetime.timedelta(minutes=15)
+
+    def __init__(self, resolver, cache_key):
+        self._resolver = resolver
+        self._cache_key = cache_key
+
+    def _fetch(self):
+
+        creds = self._resolver.load_credentials()
+        if not creds:
+            return None
+
+        # Deferred credentials are only resolved when they are used.
+        frozen_creds = creds.get_frozen_credentials()
+
+        expiry_time = getattr(creds, '_expiry_time', None)
+        if not expiry_time:
+            return creds
+
+        metadata = {
+            'access_key': frozen_creds.access_key,
+            'secret_key': frozen_creds.secret_key,
+            'token': frozen_creds.token,
+            'expiry_time': expiry_time.isoformat(),
+            'method': creds.method,
+        }
+        cache.write('credentials', self._cache_key, metadata)
+        return metadata
+
+    def _refresh(self):
+        metadata = self._fetch()
+        if not isinstance(metadata, dict):
+            raise ValueError('Credentials are no longer temporary')
+        return metadata
+
+    def load(self):
+
+        metadata, _ = cache.read('credentials', self._cache_key)
+        if metadata:
+            expires_soon = datetime.datetime.now(tzutc()) + self.expiry_window
+            if parse(metadata['expiry_time']) <= expires_soon:
+                metadata = None
+
+        if not metadata:
+            metadata = self._fetch()
+            if not isinstance(metadata, dict):
+                return metadata
+
+        return RefreshableCredentials.create_from_metadata(
+            metadata=metadata,
+            refresh_using=self._refresh,
+            method=metadata['method'],
+        )
+
+
+def install(session, aws_config):
+    """
+    Adds a credential provider to the session that uses cached credentials.
+
+    """
+
+    botocore_session = session._session
+    resolver = botocore_session.get_component('credential_provider')
+
+    # Key on everything that decides which identity the credentials are
+    # for, including profiles and credentials from the environment, so
+    # that different accounts never share cached credentials.
+    cache_key = cache.key(
+        aws_config.get('profile_name'),
+        botocore_session.profile,
+        botocore_session.get_scoped_config(),
+        dict((name, os.environ.get(name)) for name in _environment_variables),
+        session.region_name,
+    )
+    provider = CachedCredentialProvider(
+        resolver=CredentialResolver(list(resolver.providers)),
+        cache_key=cache_key,
+    )
+    resolver.providers.insert(0, provider)
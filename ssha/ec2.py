@@ -1,36 +1,477 @@
 from __future__ import print_function
 
 import datetime
-import operator
+import fnmatch
+import json
+import re
+import socket
+import time
 
-from . import aws, config, errors, ssm
+from . import aws, cache, config, errors, ssh, ssm
 
+try:
+    basestring
+except NameError:
+    basestring = str
 
-_instances = []
 
+_compiled_rules = {}
+_discovered = {}
+_executor = {}
+_listings = {}
+_pending = {}
 
-def _describe_instances():
+# The number of the closest bastions to measure the latency of,
+# and how long to keep using the fastest one.
+_probe_candidates = 3
+_probe_cache_ttl = 24 * 60 * 60
 
-    ec2 = aws.client('ec2')
+# Errors returned by the EC2 API when requests are being throttled.
+_throttling_error_codes = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException')
 
-    print('[ssha] discovering ec2 instances')
+# Instance fields that can be matched by describe_instances filters.
+# Tags are handled separately using "tag:<key>" filters.
+_filter_names = {
+    ('ImageId',): 'image-id',
+    ('InstanceId',): 'instance-id',
+    ('InstanceType',): 'instance-type',
+    ('Placement', 'AvailabilityZone'): 'availability-zone',
+    ('State', 'Name'): 'instance-state-name',
+    ('SubnetId',): 'subnet-id',
+    ('VpcId',): 'vpc-id',
+}
+
+
+def _equal(expected):
+    return lambda value: value == expected
+
+
+def _exists(expected):
+    return lambda value: (value is not None) == bool(expected)
+
+
+def _glob(expected):
+    pattern = re.compile(fnmatch.translate(expected))
+    return lambda value: isinstance(value, basestring) and pattern.match(value) is not None
+
+
+def _in(expected):
+    if not isinstance(expected, list):
+        expected = [expected]
+    return lambda value: value in expected
+
+
+def _not_equal(expected):
+    return lambda value: value != expected
+
+
+def _prefix(expected):
+    return lambda value: isinstance(value, basestring) and value.startswith(expected)
+
+
+def _regex(expected):
+    try:
+        pattern = re.compile(expected)
+    except (re.error, TypeError) as error:
+        errors.string_exit('Invalid regular expression {!r} in rules: {}'.format(expected, error))
+    return lambda value: isinstance(value, basestring) and pattern.search(value) is not None
+
+
+# Suffixes that change how the values of a nested block are compared,
+# such as TagsNotEqual, with a function that builds the comparison.
+_rule_operators = (
+    ('NotEqual', _not_equal),
+    ('Prefix', _prefix),
+    ('Glob', _glob),
+    ('Regex', _regex),
+    ('In', _in),
+    ('Exists', _exists),
+)
+
+
+class _PageSize(object):
+    """
+    Chooses the MaxResults value for each describe_instances page.
+
+    In adaptive mode, the page size starts small so the first results come
+    back quickly, then grows while pages are fetched faster than the target
+    time. It shrinks, with a backoff delay, when requests are throttled,
+    until the same request has been throttled max_retries times.
+
+    """
+
+    minimum = 5
+    maximum = 1000
+    max_retries = 8
+
+    def __init__(self, size, adaptive=False, target_seconds=1.0):
+        self.adaptive = adaptive
+        self.target_seconds = target_seconds
+        self.throttle_count = 0
+        if adaptive:
+            self.size = min(size, 100)
+        else:
+            self.size = size
+        self.size = max(min(self.size, self.maximum), self.minimum)
+
+    def throttled(self):
+        """
+        Shrinks the page size and waits before the next request.
+        Returns False if throttling is not handled by this page size,
+        or if the request should not be retried again.
+
+        """
+
+        if not self.adaptive or self.throttle_count >= self.max_retries:
+            return False
+
+        self.throttle_count += 1
+        self.size = max(self.size // 2, self.minimum)
+        time.sleep(min(0.1 * 2 ** self.throttle_count, 5))
+        return True
+
+    def update(self, seconds):
+        """
+        Adjusts the page size based on how long the last page took.
+
+        """
+
+        if not self.adaptive:
+            return
+
+        self.throttle_count = 0
+
+        # Scale towards the target time, but no more than
+        # doubling or halving the page size each time.
+        ratio = self.target_seconds / max(seconds, 0.001)
+        ratio = max(min(ratio, 2), 0.5)
+        self.size = max(min(int(self.size * ratio), self.maximum), self.minimum)
+
+
+def _cache_key(region_name, filters, ssm_rule_sets):
+    return cache.key(
+        aws.profile(),
+        region_name,
+        config.get('config.name'),
+        filters,
+        ssm_rule_sets,
+    )
+
+
+def _collect_listings(wait=False, quiet=False):
+    """
+    Stores the results of finished background listings.
+    Returns True if any listings were updated.
+
+    When discovering instances in all regions, a region that fails
+    without cached instances is skipped, with a warning unless quiet
+    is set, so that the other regions can still be used.
+
+    """
+
+    updated = False
+
+    for region_name, future in list(_pending.items()):
+
+        if not wait and not future.done():
+            continue
+
+        del _pending[region_name]
+
+        try:
+            _listings[region_name] = future.result()
+        except (Exception, SystemExit) as error:
+            # Keep using cached instances if the refresh failed.
+            if region_name in _listings:
+                continue
+            if not _all_regions():
+                raise
+            if not quiet:
+                print('[ssha] skipping {}, listing instances failed: {}'.format(region_name, error))
+            continue
+
+        updated = True
+
+    return updated
+
+
+def _compile_filters(rules, path=(), operator_name=None, filters=None):
+    """
+    Splits rules into describe_instances filters, for the rules that the
+    EC2 API can check, and the remaining rules that must be checked here.
+    Filters are returned as a dict of {name: [value]}.
+
+    """
+
+    if filters is None:
+        filters = {}
+    remaining = {}
+
+    for key, expected_value in rules.items():
+
+        if isinstance(expected_value, dict):
+
+            field, nested_operator_name = _split_operator(key)
+            _, nested_remaining = _compile_filters(
+                rules=expected_value,
+                path=path + (field,),
+                operator_name=nested_operator_name or operator_name,
+                filters=filters,
+            )
+            if nested_remaining:
+                remaining[key] = nested_remaining
+
+        else:
+
+            # Each filter can only be used once, so if another
+            # rule already uses it then check this one here.
+            name, values = _filter(path + (key,), expected_value, operator_name)
+            if name and name not in filters:
+                filters[name] = values
+            else:
+                remaining[key] = expected_value
+
+    return filters, remaining
+
+
+def _compile_rules(rules, path=(), make_test=_equal):
+    """
+    Compiles rules into a flat list of functions that
+    each check one value of an instance.
+
+    """
+
+    predicates = []
+
+    for key, expected_value in rules.items():
+
+        if isinstance(expected_value, dict):
+
+            field, operator_name = _split_operator(key)
+            if operator_name:
+                nested_make_test = dict(_rule_operators)[operator_name]
+            else:
+                nested_make_test = make_test
+
+            predicates.extend(_compile_rules(expected_value, path + (field,), nested_make_test))
+
+        else:
+
+            predicates.append(_predicate(path + (key,), make_test(expected_value)))
+
+    return predicates
+
+
+def _describe_instances(ec2, filters):
+
+    from botocore.exceptions import ClientError
+
+    page_size = _PageSize(
+        size=config.get('ec2.page_size') or _PageSize.maximum,
+        adaptive=bool(config.get('ec2.adaptive_page_size')),
+    )
+
+    kwargs = {}
+    if filters:
+        kwargs['Filters'] = [{'Name': name, 'Values': values} for name, values in sorted(filters.items())]
+
+    while True:
+
+        kwargs['MaxResults'] = page_size.size
+
+        start = time.time()
+        try:
+            page = ec2.describe_instances(**kwargs)
+        except ClientError as error:
+            if error.response['Error']['Code'] in _throttling_error_codes and page_size.throttled():
+                continue
+            raise
+        page_size.update(time.time() - start)
 
-    paginator = ec2.get_paginator('describe_instances')
-    page_iterator = paginator.paginate(MaxResults=15)
-    for page in page_iterator:
         if page['ResponseMetadata']['HTTPStatusCode'] != 200:
             errors.json_exit(page)
         for reservation in page['Reservations']:
             for instance in reservation['Instances']:
                 yield instance
 
+        kwargs['NextToken'] = page.get('NextToken')
+        if not kwargs['NextToken']:
+            break
+
+
+def _filter(path, value, operator_name=None):
+    """
+    Returns the describe_instances filter name and values for a rule,
+    or (None, None) if the EC2 API can't check it.
+
+    """
+
+    if operator_name == 'Exists':
+        # Instances with a tag can be found with the tag-key filter.
+        if value is True and len(path) == 2 and path[0] == 'Tags' and _plain(path[1]):
+            return 'tag-key', [path[1]]
+        return None, None
+
+    if len(path) == 2 and path[0] == 'Tags':
+        name = 'tag:' + path[1]
+    else:
+        name = _filter_names.get(path)
+
+    if not name:
+        return None, None
+
+    if operator_name is None and _plain(value):
+        return name, [value]
+
+    # Filter values support * and ? wildcards.
+    if operator_name == 'Prefix' and _plain(value):
+        return name, [value + '*']
+    if operator_name == 'Glob' and isinstance(value, basestring) and value and '[' not in value and '\\' not in value:
+        return name, [value]
+    if operator_name == 'In' and isinstance(value, list) and value and all(_plain(item) for item in value):
+        return name, value
+
+    return None, None
+
+
+def _list_instances(region_name, ec2, ssm_client, ssm_rule_sets, filters, cache_key):
+
+    instances = []
+    for instance in _describe_instances(ec2, filters):
+        tags = {}
+        for tag in instance.get('Tags') or []:
+            tags[tag['Key']] = tag['Value']
+        instance['Tags'] = tags
+        instance['Region'] = region_name
+        instances.append(instance)
+
+    if instances and ssm_client:
+
+        instance_ids = _ssm_candidates(instances, ssm_rule_sets)
+        if instance_ids:
+            instances_by_id = dict((instance['InstanceId'], instance) for instance in instances)
+            for instance_id in instance_ids:
+                instances_by_id[instance_id][ssm.looked_up_field] = True
+            for info in ssm.find_instances(ssm_client, instance_ids):
+                instance = instances_by_id.get(info['InstanceId'])
+                if instance:
+                    instance.update(info)
+
+    cache.write('instances', cache_key, instances)
+    return instances
+
+
+def _all_regions():
+    """
+    Returns the regions to use when discovering instances in all regions,
+    or None if discovering instances in a single region.
+
+    """
+
+    if config.get('discover.all_regions') and not config.get('aws.region_name'):
+        return config.get('ssha.regions')
+    return None
 
-def _filter_instances(instances, rules):
-    result = []
-    for instance in instances:
-        if _rules_pass(instance, rules):
-            result.append(instance)
-    return result
+
+def _bastion_enabled():
+    return bool(config.get('bastion') and not config.get('bastion.disabled'))
+
+
+def _ssm_rule_sets():
+    """
+    Returns the EC2 rules for instances that need SSM information.
+
+    """
+
+    rule_sets = []
+    if config.get('discover.ssm') or config.get('ssm.session_manager'):
+        rule_sets.append(config.get('discover.ec2') or {})
+    if _bastion_enabled() and config.get('bastion.ssm'):
+        rule_sets.append(config.get('bastion.ec2') or {})
+    return rule_sets
+
+
+def _listing_filters():
+    """
+    Returns the describe_instances filters for listing instances.
+    The same listing is used for discovering instances and bastions,
+    so only filters that apply to both can be used. A bastion block
+    without rules, such as one with only a hostname, is left out, as
+    otherwise it would match every instance and prevent any filtering.
+
+    """
+
+    rule_sets = [config.get('discover.ec2') or {}]
+    if _bastion_enabled() and (config.get('bastion.ec2') or config.get('bastion.ssm')):
+        rule_sets.append(config.get('bastion.ec2') or {})
+
+    filter_sets = [_compile_filters(rules)[0] for rules in rule_sets]
+
+    filters = {}
+    for name in filter_sets[0]:
+        if all(name in other_filters for other_filters in filter_sets[1:]):
+            values = set()
+            for other_filters in filter_sets:
+                values.update(other_filters[name])
+            filters[name] = sorted(values)
+    return filters
+
+
+def _load_instances(wait):
+    """
+    Lists instances in each region, using the inventory cache when possible.
+    Missing and stale listings are fetched concurrently in the background.
+    Stale cached instances are used straight away, unless wait is set.
+
+    """
+
+    start_discovery(wait=wait)
+
+    if wait:
+        _collect_listings(wait=True)
+    elif _pending and not _listings:
+        # There is nothing to show yet, so wait for the first region.
+        import concurrent.futures
+        concurrent.futures.wait(list(_pending.values()), return_when=concurrent.futures.FIRST_COMPLETED)
+        _collect_listings()
+
+
+def _regions():
+    """
+    Returns the regions to discover instances in.
+
+    """
+
+    return _all_regions() or [config.get('aws.region_name') or aws.session().region_name]
+
+
+def _submit(func, *args):
+    """
+    Runs a function in a thread pool. The pool size is limited
+    to avoid API throttling when discovering many regions.
+
+    """
+
+    if 'pool' not in _executor:
+        import concurrent.futures
+        _executor['pool'] = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('ec2.max_workers') or 4,
+        )
+    return _executor['pool'].submit(func, *args)
+
+
+def _filter_instances(instances, *rule_sets):
+    """
+    Returns the instances that pass all of the rule sets,
+    checking each instance once.
+
+    """
+
+    predicates = []
+    for rules in rule_sets:
+        predicates.extend(_rule_predicates(rules))
+
+    return [instance for instance in instances if _passes(instance, predicates)]
 
 
 def _instance_sort_key(instance):
@@ -42,85 +483,301 @@ def _instance_sort_key(instance):
             if not value:
                 break
         result.append(value or '')
+    result.append(instance.get('Region') or '')
     return result
 
 
-def _rules_pass(obj, rules, compare=operator.eq):
+def _passes(instance, predicates):
+    for predicate in predicates:
+        if not predicate(instance):
+            return False
+    return True
 
-    for key, expected_value in rules.items():
 
-        if isinstance(expected_value, dict):
+def _plain(value):
+    """
+    Checks if a value can be used as a filter value. Filter values can
+    contain wildcards, and empty values would not match, so anything
+    unusual is left to be checked here.
 
-            if key.endswith('NotEqual'):
-                nested_compare = operator.ne
-                key = key[:-len('NotEqual')]
-            else:
-                nested_compare = compare
+    """
 
-            nested_rules_passed = _rules_pass(
-                obj=obj.get(key) or {},
-                rules=expected_value,
-                compare=nested_compare,
-            )
-            if not nested_rules_passed:
-                return False
+    if not isinstance(value, basestring) or not value:
+        return False
+    return '*' not in value and '?' not in value and '\\' not in value
 
-        elif not compare(obj.get(key), expected_value):
-            return False
 
-    return True
+def _predicate(path, test):
+    """
+    Returns a function that checks the value at a path in an instance.
 
+    """
 
-def _find_instances(ec2_filters, ssm_filters):
+    if len(path) == 1:
+        key = path[0]
+        return lambda instance: test(instance.get(key))
 
-    if not _instances:
-        for instance in _describe_instances():
-            tags = {}
-            for tag in instance.get('Tags') or []:
-                tags[tag['Key']] = tag['Value']
-            instance['Tags'] = tags
-            _instances.append(instance)
+    parents, key = path[:-1], path[-1]
 
-    instances = _instances
+    def predicate(instance):
+        value = instance
+        for parent in parents:
+            value = value.get(parent) or {}
+        return test(value.get(key))
 
-    if instances and ec2_filters:
-        instances = _filter_instances(instances, ec2_filters)
+    return predicate
 
-    if instances and ssm_filters:
-        for info in ssm.find_instances():
-            for instance in instances:
-                if instance['InstanceId'] == info['InstanceId']:
-                    instance.update(info)
-                    break
-        instances = _filter_instances(instances, ssm_filters)
 
-    return instances
+def _rule_predicates(rules):
+    """
+    Returns the compiled rules, compiling them the first time.
 
+    """
 
-def discover_bastion(instance):
-    bastions = _find_instances(
-        ec2_filters=config.get('bastion.ec2'),
-        ssm_filters=config.get('bastion.ssm'),
-    )
+    if not rules:
+        return []
+
+    cache_key = json.dumps(rules, sort_keys=True, default=str)
+    predicates = _compiled_rules.get(cache_key)
+    if predicates is None:
+        predicates = _compiled_rules[cache_key] = _compile_rules(rules)
+    return predicates
+
+
+def _rules_pass(obj, rules):
+    return _passes(obj, _rule_predicates(rules))
+
+
+def _ssm_candidates(instances, rule_sets):
+    """
+    Returns the IDs of instances that could pass the rules that need
+    SSM information, so that only those instances are looked up.
+
+    """
+
+    predicate_sets = [_rule_predicates(rules) for rules in rule_sets]
+    instance_ids = []
+    for instance in instances:
+        if any(_passes(instance, predicates) for predicates in predicate_sets):
+            instance_ids.append(instance['InstanceId'])
+    return instance_ids
+
+
+def _split_operator(key):
+    """
+    Splits a key like TagsNotEqual into ("Tags", "NotEqual").
+    Returns (key, None) for keys without an operator suffix.
+
+    """
+
+    for operator_name, _ in _rule_operators:
+        if key.endswith(operator_name) and len(key) > len(operator_name):
+            return key[:-len(operator_name)], operator_name
+    return key, None
+
+
+def _block_predicates(ec2_filters, ssm_filters):
+    """
+    Returns the compiled rules for a discover or bastion block.
+
+    """
+
+    if ec2_filters:
+        # The EC2 API has already checked the rules that it could,
+        # unless the listing was shared with differing rules.
+        filters, remaining_filters = _compile_filters(ec2_filters)
+        if filters == _listing_filters():
+            ec2_filters = remaining_filters
+
+    return _rule_predicates(ec2_filters) + _rule_predicates(ssm_filters)
+
+
+def _discover(wait=True):
+    """
+    Splits the listed instances into targets and bastions in one pass,
+    and indexes the bastions by location. The result is reused until
+    the listings or rules change.
+
+    """
+
+    _load_instances(wait=wait)
+
+    listings = [_listings.get(region_name) or [] for region_name in _regions()]
+
+    rules = [config.get('discover.ec2'), config.get('discover.ssm')]
+    if _bastion_enabled():
+        rules += [config.get('bastion.ec2'), config.get('bastion.ssm')]
+    rules_key = json.dumps(rules, sort_keys=True, default=str)
+
+    if _discovered.get('rules_key') == rules_key and len(_discovered['listings']) == len(listings):
+        if all(old is new for old, new in zip(_discovered['listings'], listings)):
+            return _discovered
+
+    target_predicates = _block_predicates(*rules[:2])
+    bastion_predicates = _block_predicates(*rules[2:]) if len(rules) > 2 else None
+
+    targets = []
+    bastions = []
+    for listing in listings:
+        for instance in listing:
+            if _passes(instance, target_predicates):
+                targets.append(instance)
+            if bastion_predicates is not None and _passes(instance, bastion_predicates):
+                bastions.append(instance)
+
+    bastion_index = {}
     for bastion in bastions:
-        if bastion['InstanceId'] == instance['InstanceId']:
-            return None
-    if bastions:
-        return bastions[0]
-    else:
+        for key in _locality_keys(bastion):
+            bastion_index.setdefault(key, []).append(bastion)
+
+    _discovered.clear()
+    _discovered.update({
+        'bastion_ids': set(bastion['InstanceId'] for bastion in bastions),
+        'bastion_index': bastion_index,
+        'bastions': bastions,
+        'listings': listings,
+        'rules_key': rules_key,
+        'targets': sorted(targets, key=_instance_sort_key),
+    })
+    return _discovered
+
+
+def _locality_keys(instance):
+    """
+    Returns keys for an instance's location, from the most specific
+    to the least. Bastions sharing a key with an instance are closer
+    to it on the network.
+
+    """
+
+    region_name = instance.get('Region')
+    vpc_id = instance.get('VpcId')
+    subnet_id = instance.get('SubnetId')
+    availability_zone = (instance.get('Placement') or {}).get('AvailabilityZone')
+
+    keys = []
+    if subnet_id:
+        keys.append(('subnet', region_name, subnet_id))
+    if vpc_id and availability_zone:
+        keys.append(('zone', region_name, vpc_id, availability_zone))
+    if vpc_id:
+        keys.append(('vpc', region_name, vpc_id))
+    keys.append(('region', region_name))
+    return keys
+
+
+def _connect_time(address, port, timeout):
+    """
+    Returns the number of seconds taken to open a TCP
+    connection, or None if it could not connect.
+
+    """
+
+    start = time.time()
+    try:
+        connection = socket.create_connection((address, port), timeout=timeout)
+    except (socket.error, socket.timeout):
+        return None
+    connection.close()
+    return time.time() - start
+
+
+def _probe_bastions(instance, bastions):
+    """
+    Returns the bastion with the fastest TCP connection out of the closest
+    few. The result is cached for the instance's VPC, and reused while that
+    bastion is still available.
+
+    """
+
+    cache_key = None
+    if instance.get('VpcId'):
+        cache_key = cache.key(
+            aws.profile(),
+            instance.get('Region'),
+            config.get('config.name'),
+            instance['VpcId'],
+        )
+        if not config.get('refresh'):
+            instance_id, age = cache.read('bastions', cache_key)
+            if instance_id and age < _probe_cache_ttl:
+                for bastion in bastions:
+                    if bastion['InstanceId'] == instance_id:
+                        return bastion
+
+    import concurrent.futures
+
+    candidates = bastions[:_probe_candidates]
+    port = config.get('bastion.probe_port') or 22
+    timeout = config.get('bastion.probe_timeout') or 1
+
+    print('[ssha] measuring latency to {} bastions'.format(len(candidates)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        seconds = list(executor.map(
+            lambda bastion: _connect_time(ssh.get_ip(bastion, connect_through_bastion=False), port, timeout),
+            candidates,
+        ))
+
+    reachable = [(value, index) for index, value in enumerate(seconds) if value is not None]
+    if not reachable:
+        # Fall back to the closest bastion, and try again next time.
+        return candidates[0]
+
+    bastion = candidates[min(reachable)[1]]
+    if cache_key:
+        cache.write('bastions', cache_key, bastion['InstanceId'])
+    return bastion
+
+
+def _rank_bastions(instance, discovered):
+    """
+    Returns the bastions sorted by how close they are to an instance:
+    in the same subnet, then availability zone, then VPC, then region.
+
+    """
+
+    ranked = []
+    seen = set()
+    for key in _locality_keys(instance) + [None]:
+        if key is None:
+            bastions = discovered['bastions']
+        else:
+            bastions = discovered['bastion_index'].get(key, [])
+        for bastion in bastions:
+            if bastion['InstanceId'] not in seen:
+                seen.add(bastion['InstanceId'])
+                ranked.append(bastion)
+    return ranked
+
+
+def discover_bastion(instance):
+    """
+    Returns the closest bastion to an instance, or the fastest of the
+    closest bastions when bastion.probe is set. Returns None if the
+    instance is a bastion itself.
+
+    """
+
+    discovered = _discover()
+    if instance['InstanceId'] in discovered['bastion_ids']:
+        return None
+    if not discovered['bastions']:
         errors.string_exit('Bastion not found')
 
+    bastions = _rank_bastions(instance, discovered)
+    if config.get('bastion.probe') and len(bastions) > 1:
+        return _probe_bastions(instance, bastions)
+    return bastions[0]
 
-def discover_instances():
-    instances = _find_instances(
-        ec2_filters=config.get('discover.ec2'),
-        ssm_filters=config.get('discover.ssm'),
-    )
-    return sorted(instances, key=_instance_sort_key)
+
+def discover_instances(wait=True):
+    return list(_discover(wait=wait)['targets'])
 
 
 def label(instance):
     result = []
+    if _all_regions():
+        result.append(instance.get('Region') or '')
     for field in config.get('display.fields') or []:
         value = instance
         for key in field.split('.'):
@@ -128,4 +785,76 @@ def label(instance):
         if isinstance(value, datetime.datetime):
             value = '[{:%Y-%m-%d %H:%M}]'.format(value)
         result.append(value or '')
-    return result or [instance['InstanceId']]
+    if not config.get('display.fields'):
+        result.append(instance['InstanceId'])
+    return result
+
+
+def refreshed_instances(wait=False):
+    """
+    Returns the discovered instances again if a background listing
+    has finished since the last call, otherwise returns None.
+
+    """
+
+    # This is used while the menu is displayed, so failed
+    # regions are skipped without printing anything.
+    if _collect_listings(wait=wait, quiet=True):
+        return discover_instances(wait=False)
+    return None
+
+
+def refreshing():
+    """
+    Returns True if instances are being listed in the background.
+
+    """
+
+    return bool(_pending)
+
+
+def start_discovery(wait=True):
+    """
+    Starts listing instances in the background, for regions without fresh
+    cached instances, and returns without waiting for them. This must run
+    in the main thread, in case the user is prompted for an MFA token.
+    The wait argument only changes the message that is printed.
+
+    """
+
+    if _listings or _pending:
+        return
+
+    filters = _listing_filters()
+    ssm_rule_sets = _ssm_rule_sets()
+    ttl = config.get('ec2.cache_ttl') or 300
+
+    refreshing = []
+    for region_name in _regions():
+
+        cache_key = _cache_key(region_name, filters, ssm_rule_sets)
+
+        cached, age = None, None
+        if not config.get('refresh'):
+            cached, age = cache.read('instances', cache_key)
+
+        if cached is not None:
+            _listings[region_name] = cached
+            if age < ttl:
+                continue
+
+        # Create the clients here rather than in the background,
+        # in case the user needs to be prompted for an MFA token.
+        ec2 = aws.client('ec2', region_name=region_name)
+        ssm_client = aws.client('ssm', region_name=region_name) if ssm_rule_sets else None
+
+        _pending[region_name] = _submit(
+            _list_instances, region_name, ec2, ssm_client, ssm_rule_sets, filters, cache_key,
+        )
+        refreshing.append(region_name)
+
+    if refreshing:
+        if _listings and not wait:
+            print('[ssha] refreshing ec2 instances in the background')
+        else:
+            print('[ssha] discovering ec2 instances')
@@ -0,0 +1,72 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import subprocess
+import sys
+import threading
+import time
+
+
+_print_lock = threading.Lock()
+
+
+def _print(line):
+    with _print_lock:
+        print(line)
+        sys.stdout.flush()
+
+
+def _run(name, command):
+    """
+    Runs a shell command, printing each line of output prefixed
+    with the name. Returns a tuple of (exit code, seconds taken).
+
+    """
+
+    start = time.time()
+
+    with open(os.devnull) as devnull:
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=devnull,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        for line in iter(process.stdout.readline, b''):
+            _print('[{}] {}'.format(name, line.decode('utf-8', 'replace').rstrip('\r\n')))
+        process.stdout.close()
+        returncode = process.wait()
+
+    return returncode, time.time() - start
+
+
+def run(commands, max_workers):
+    """
+    Runs shell commands concurrently, streaming their output with the
+    name of each command, then prints a summary. The commands are a list
+    of (name, command) tuples. Returns a list of (exit code, seconds taken)
+    for each command.
+
+    """
+
+    import concurrent.futures
+
+    _print('[ssha] running on {} instances, {} at a time'.format(len(commands), max_workers))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_run, name, command) for name, command in commands]
+        results = [future.result() for future in futures]
+
+    width = max(len(name) for name, _ in commands)
+    failed = 0
+
+    _print('[ssha] summary:')
+    for (name, _), (returncode, seconds) in zip(commands, results):
+        if returncode != 0:
+            failed += 1
+        _print('  {}  exit {:<3}  {:.1f}s'.format(name.ljust(width), returncode, seconds))
+    _print('[ssha] {} succeeded, {} failed'.format(len(commands) - failed, failed))
+
+    return results
@@ -1,18 +1,15 @@
-from boto_source_profile_mfa import SourceProfileMfaCredentialProvider
+import threading
 
-from botocore.credentials import AssumeRoleProvider
-
-from . import aws, errors
+from . import aws, cache, config, errors
 
 
 _cache = {}
 
+# How long to use cached IAM groups before refreshing them, in seconds.
+_default_cache_ttl = 60 * 60
 
-def _list_groups_for_user(username):
-
-    iam = aws.client('iam')
 
-    print('[ssha] discovering iam groups')
+def _list_groups_for_user(iam, username):
 
     groups = []
 
@@ -37,24 +34,84 @@ def _list_groups_for_user(username):
             return groups
 
 
-def groups():
-    if 'groups' not in _cache:
-        username = user()
-        if username:
-            _cache['groups'] = _list_groups_for_user(username)
-        else:
-            _cache['groups'] = []
-    return _cache['groups']
+def _lookup(iam, cache_key):
+    """
+    Looks up the current IAM user and their groups, and caches them.
 
+    """
 
-def user():
-    if 'user' not in _cache:
+    username = iam.get_user()['User']['UserName']
+
+    identity = {
+        'user': username,
+        'groups': _list_groups_for_user(iam, username),
+    }
+    cache.write('iam', cache_key, identity)
+    return identity
+
+
+def _refresh(iam, cache_key):
+    try:
+        _lookup(iam, cache_key)
+    except (Exception, SystemExit):
+        # Keep using the cached groups, and try again next time.
+        pass
+
+
+def _identity():
+    """
+    Returns the current IAM user and their groups, or None if the
+    credentials are not for an IAM user. These are cached on disk per
+    access key. Cached values are used straight away, and if they are
+    older than iam.cache_ttl then they are refreshed in the background
+    for next time.
+
+    """
+
+    if 'identity' not in _cache:
+
+        from boto_source_profile_mfa import SourceProfileMfaCredentialProvider
+        from botocore.credentials import AssumeRoleProvider
+
+        # Credentials are resolved here, rather than in the background,
+        # in case the user needs to be prompted for an MFA token.
         creds = aws.credentials()
         if creds.method in (SourceProfileMfaCredentialProvider.METHOD, AssumeRoleProvider.METHOD):
-            _cache['user'] = None
-        else:
-            print('[ssha] discovering iam user')
-            iam = aws.resource('iam')
-            user = iam.CurrentUser()
-            _cache['user'] = user.user_name
-    return _cache['user']
+            _cache['identity'] = None
+            return None
+
+        cache_key = cache.key(creds.get_frozen_credentials().access_key)
+        iam = aws.client('iam')
+
+        identity = None
+        if not config.get('refresh'):
+            identity, age = cache.read('iam', cache_key)
+
+        if identity is None:
+            print('[ssha] discovering iam user and groups')
+            identity = _lookup(iam, cache_key)
+        elif age >= (config.get('iam.cache_ttl') or _default_cache_ttl):
+            # The refresh can be stopped while writing when ssha exits,
+            # so remove any files left by previous refreshes first.
+            cache.clean('iam')
+            thread = threading.Thread(target=_refresh, args=(iam, cache_key))
+            thread.daemon = True
+            thread.start()
+
+        _cache['identity'] = identity
+
+    return _cache['identity']
+
+
+def groups():
+    identity = _identity()
+    if identity:
+        return identity['groups']
+    return []
+
+
+def user():
+    identity = _identity()
+    if identity:
+        return identity['user']
+    return None
@@ -0,0 +1,136 @@
+from __future__ import unicode_literals
+
+import binascii
+import os
+import subprocess
+import tempfile
+import threading
+
+from . import cache
+
+
+# Supported values for ssh.temporary_key_type.
+key_types = ('ed25519', 'rsa')
+
+# How long pre-generated keys can wait in the pool before being used.
+_pool_key_ttl = 24 * 60 * 60
+
+
+def _fill_pool(key_type, size):
+    """
+    Generates keys until the pool has enough of them.
+
+    """
+
+    # Remove any private keys left in partly written
+    # files, when a previous run exited while filling it.
+    cache.clean(_pool_namespace(key_type))
+
+    for _ in range(size - len(cache.names(_pool_namespace(key_type)))):
+        private_key, public_key = generate(key_type)
+        name = binascii.hexlify(os.urandom(8)).decode('ascii')
+        cache.write(_pool_namespace(key_type), name, {
+            'private_key': private_key,
+            'public_key': public_key,
+        })
+
+
+def _pool_namespace(key_type):
+    return 'temporary_keys-' + key_type
+
+
+def _take_from_pool(key_type):
+    """
+    Returns a (private key, public key) tuple from the pool,
+    or None if there are no fresh keys in it.
+
+    """
+
+    for name in cache.names(_pool_namespace(key_type)):
+        value, age = cache.take(_pool_namespace(key_type), name)
+        if value is not None and age < _pool_key_ttl:
+            return value['private_key'], value['public_key']
+    return None
+
+
+def add_to_agent(private_key, lifetime=60):
+    """
+    Adds a private key to the SSH agent for a number of seconds.
+
+    """
+
+    with tempfile.NamedTemporaryFile(suffix='-ssha-temporary-key') as temp_key:
+        os.chmod(temp_key.name, 0o600)
+        with open(temp_key.name, 'w') as open_file:
+            open_file.write(private_key)
+        process = subprocess.Popen(
+            ['ssh-add', '-t', str(lifetime), temp_key.name],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        output = process.communicate()[0]
+
+    if process.returncode != 0:
+        raise RuntimeError('Could not add the temporary key to the SSH agent: {}'.format(
+            output.decode('utf-8', 'replace').strip(),
+        ))
+
+
+def generate(key_type):
+    """
+    Generates a key pair, returning a tuple of (private key, public key)
+    in formats that ssh-add and authorized_keys files accept.
+
+    """
+
+    from cryptography.hazmat.primitives import serialization as crypto_serialization
+
+    if key_type == 'ed25519':
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        key = ed25519.Ed25519PrivateKey.generate()
+        private_format = crypto_serialization.PrivateFormat.OpenSSH
+    elif key_type == 'rsa':
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.hazmat.backends import default_backend as crypto_default_backend
+        key = rsa.generate_private_key(
+            backend=crypto_default_backend(),
+            public_exponent=65537,
+            key_size=4096,
+        )
+        private_format = crypto_serialization.PrivateFormat.PKCS8
+    else:
+        raise ValueError('Unsupported key type {!r}'.format(key_type))
+
+    private_key = key.private_bytes(
+        crypto_serialization.Encoding.PEM,
+        private_format,
+        crypto_serialization.NoEncryption(),
+    ).decode()
+    public_key = key.public_key().public_bytes(
+        crypto_serialization.Encoding.OpenSSH,
+        crypto_serialization.PublicFormat.OpenSSH,
+    ).decode()
+
+    return private_key, public_key
+
+
+def temporary_key(key_type, pool_size=0):
+    """
+    Returns the public key of a new temporary key pair, after adding the
+    private key to the SSH agent. If pool_size is set, the key is taken
+    from a pool of pre-generated keys when possible, and the pool is
+    refilled in the background. The pool is stored in the cache, so it
+    is not used when the cache is disabled.
+
+    """
+
+    key_pair = None
+    if pool_size and cache.enabled():
+        key_pair = _take_from_pool(key_type)
+        thread = threading.Thread(target=_fill_pool, args=(key_type, pool_size))
+        thread.daemon = True
+        thread.start()
+
+    private_key, public_key = key_pair or generate(key_type)
+    add_to_agent(private_key)
+    return public_key
@@ -3,18 +3,116 @@ import curses
 import re
 
 from curses import panel
+from itertools import repeat
 
 from . import ec2
 
+try:
+    unicode
+except NameError:
+    unicode = str
 
 Item = collections.namedtuple('Item', field_names=('label', 'value'))
 
+# Keys for deleting the last character of the search string.
+_backspace_keys = (curses.KEY_BACKSPACE, 8, 127)
+
+# The key code for Escape.
+_escape_key = 27
+
+
+class Search(object):
+    """
+    Filters items by a search string as it is typed. The labels are
+    lowercased once, and items match if the characters of the search
+    string appear in their label in order. Labels containing the whole
+    search string come first, then labels where the characters are
+    closest together.
+
+    The results for each search string are kept, so typing another
+    character only checks the items that already matched, and deleting
+    a character does not check any.
+
+    """
+
+    def __init__(self, items):
+        self.items = items
+        self.labels = [unicode(item.label).lower() for item in items]
+        indexes = list(range(len(items)))
+        self.results = [('', indexes, [-1] * len(items), indexes)]
+
+    def _match(self, query, previous_query, candidates, positions):
+        """
+        Returns the indexes of the candidates that match, in their original
+        order, where the last character matched in each of their labels,
+        and the indexes with the best matches first.
+
+        Each character is matched at its first occurrence after the previous
+        one, so the previous matches are extended rather than searched again.
+        The labels are searched with map rather than a loop, because this runs
+        for every keystroke and there can be thousands of them.
+
+        """
+
+        candidate_labels = [self.labels[index] for index in candidates]
+
+        for char in query[len(previous_query):]:
+            starts = [position + 1 for position in positions]
+            positions = list(map(unicode.find, candidate_labels, repeat(char), starts))
+            if -1 in positions:
+                keep = [number for number, position in enumerate(positions) if position >= 0]
+                candidates = [candidates[number] for number in keep]
+                candidate_labels = [candidate_labels[number] for number in keep]
+                positions = [positions[number] for number in keep]
+
+        word_matches = []
+        substring_matches = []
+
+        # Other matches are ranked by how many characters they span. Spans
+        # are short, so group them by span rather than sorting them all.
+        fuzzy_matches = {}
+        first_char = query[0]
+
+        substring_positions = map(unicode.find, candidate_labels, repeat(query))
+        for index, label, substring_position, position in zip(
+            candidates, candidate_labels, substring_positions, positions,
+        ):
+            if substring_position == 0 or (substring_position > 0 and not label[substring_position - 1].isalnum()):
+                word_matches.append(index)
+            elif substring_position > 0:
+                substring_matches.append(index)
+            else:
+                span = position - label.find(first_char)
+                fuzzy_matches.setdefault(span, []).append(index)
+
+        ranked = word_matches + substring_matches
+        for span in sorted(fuzzy_matches):
+            ranked += fuzzy_matches[span]
+        return candidates, positions, ranked
+
+    def filter(self, query):
+        """
+        Returns the items that match a search string, best first.
+
+        """
+
+        query = query.lower()
+
+        while not query.startswith(self.results[-1][0]):
+            self.results.pop()
+
+        previous_query, matched, positions, ranked = self.results[-1]
+        if query != previous_query:
+            matched, positions, ranked = self._match(query, previous_query, matched, positions)
+            self.results.append((query, matched, positions, ranked))
+
+        return [self.items[index] for index in ranked]
+
 
 class Menu(object):
 
-    def __init__(self, title, items, stdscreen):
+    def __init__(self, title, items, stdscreen, refresh=None, refreshing=None):
         self.window = stdscreen.subwin(0, 0)
-        self.window.timeout(1000)
         self.window.keypad(1)
         self.panel = panel.new_panel(self.window)
         self.panel.hide()
@@ -24,7 +122,22 @@ class Menu(object):
 
         self.position = 0
         self.items = items
+        self.refresh = refresh
+        self.refreshing = refreshing
+
+        # The search string while searching, otherwise None.
+        self.query = None
+        self.search = Search(items)
+
+        # The index of the first visible item.
+        self.top = 0
+
+        # The (string, attr) displayed on each line, so that
+        # lines are only displayed again when they change.
+        self.lines = {}
 
+        self.max_x = None
+        self.max_y = None
         self.offset_x = 2
 
     def addstr(self, y, x, string, attr):
@@ -38,23 +151,16 @@ class Menu(object):
             else:
                 raise
 
-    def addline(self, y, string, attr):
+    def addline(self, y, string, attr=curses.A_NORMAL):
         """
         Displays a string on the screen. Handles truncation and borders.
+        Does nothing if the line is already displayed.
 
         """
 
         if y >= self.max_y:
             return
 
-        # Display the left blank border.
-        self.addstr(
-            y=y,
-            x=0,
-            string=' ' * self.offset_x,
-            attr=curses.A_NORMAL,
-        )
-
         # Remove trailing spaces so the truncate logic works correctly.
         string = string.rstrip()
 
@@ -67,6 +173,18 @@ class Menu(object):
         # from other lines that had been displayed here previously.
         string += ' ' * (self.max_x - self.offset_x - len(string) - self.offset_x)
 
+        if self.lines.get(y) == (string, attr):
+            return
+        self.lines[y] = (string, attr)
+
+        # Display the left blank border.
+        self.addstr(
+            y=y,
+            x=0,
+            string=' ' * self.offset_x,
+            attr=curses.A_NORMAL,
+        )
+
         # Display the string.
         self.addstr(
             y=y,
@@ -83,6 +201,102 @@ class Menu(object):
             attr=curses.A_NORMAL,
         )
 
+    def draw(self):
+        """
+        Displays the title, the visible items and the search string.
+        Only lines that have changed since the last call are displayed.
+
+        """
+
+        max_y, max_x = self.window.getmaxyx()
+        if (max_y, max_x) != (self.max_y, self.max_x):
+            # The screen was resized, so display everything again.
+            self.max_y, self.max_x = max_y, max_x
+            self.window.clear()
+            self.lines.clear()
+
+        # Display the menu title.
+        if self.title:
+            self.addline(1, self.title)
+            self.addline(2, '-' * len(self.title))
+            offset_top = 3
+        else:
+            offset_top = 1
+        offset_bottom = 1
+
+        height = max(self.max_y - offset_top - offset_bottom, 0)
+
+        # Scroll as little as possible to keep the selected item visible.
+        if self.position < self.top:
+            self.top = self.position
+        elif self.position >= self.top + height:
+            self.top = self.position - height + 1
+        self.top = max(min(self.top, len(self.items) - height), 0)
+
+        visible = self.items[self.top:self.top + height]
+        for row in range(height):
+            if row < len(visible):
+                # Highlight the selected item.
+                if self.top + row == self.position:
+                    mode = curses.A_REVERSE
+                else:
+                    mode = curses.A_NORMAL
+                self.addline(offset_top + row, visible[row].label, mode)
+            else:
+                self.addline(offset_top + row, '', curses.A_NORMAL)
+
+        # Display the search string on the bottom line.
+        for y in range(self.max_y - offset_bottom, self.max_y):
+            if self.query is not None and y == self.max_y - 1:
+                status = '/{}  ({} of {})'.format(self.query, len(self.items), len(self.search.items))
+                self.addline(y, status, curses.A_BOLD)
+            else:
+                self.addline(y, '', curses.A_NORMAL)
+
+        self.window.refresh()
+
+    def page_height(self):
+        """
+        Returns the number of items that fit on the screen.
+
+        """
+
+        offset_top = 3 if self.title else 1
+        offset_bottom = 1
+        return max(self.max_y - offset_top - offset_bottom, 0)
+
+    def update(self):
+        """
+        Replaces the items if the refresh function returns new ones,
+        keeping the selected item where possible.
+
+        """
+
+        items = self.refresh()
+        if items is None:
+            return
+
+        selected = self.items[self.position].label if self.items else None
+
+        self.search = Search(items)
+        self.items = self.search.filter(self.query or '')
+        self.position = 0
+        for index, item in enumerate(self.items):
+            if item.label == selected:
+                self.position = index
+                break
+
+    def filter(self, query):
+        """
+        Shows the items matching a search string,
+        selecting the best match.
+
+        """
+
+        self.query = query
+        self.items = self.search.filter(query or '')
+        self.position = 0
+
     def navigate(self, n):
         self.position += n
         if self.position < 0:
@@ -90,75 +304,67 @@ class Menu(object):
         elif self.position >= len(self.items):
             self.position = 0
 
+    def move_to(self, position):
+        """
+        Selects an item, stopping at the first and last items.
+
+        """
+
+        self.position = max(min(position, len(self.items) - 1), 0)
+
     def display(self):
 
         self.panel.top()
         self.panel.show()
         self.window.clear()
+        self.lines.clear()
 
         while True:
 
-            self.window.refresh()
-            curses.doupdate()
+            if self.refresh:
+                self.update()
 
-            self.max_y, self.max_x = self.window.getmaxyx()
+            self.draw()
 
-            # Display the menu title.
-            if self.title:
-                self.addline(1, self.title)
-                self.addline(2, '-' * len(self.title))
-                offset_top = 3
+            # Wait for a key. While the items are being refreshed, wake up
+            # every second to check for them, otherwise only wake up when
+            # a key is pressed or the screen is resized.
+            if self.refresh and (self.refreshing is None or self.refreshing()):
+                self.window.timeout(1000)
             else:
-                offset_top = 1
-            offset_bottom = 1
-
-            window_height = max(self.max_y - offset_top - offset_bottom - 1, 0)
-
-            if self.position < window_height:
-                window = (0, window_height)
-            else:
-                window = (self.position - window_height, self.position)
-
-            row = 0
-
-            for index, item in enumerate(self.items):
+                self.window.timeout(-1)
 
-                if index < window[0] or index > window[1]:
-                    continue
-
-                # Highlight the selected item.
-                if index == self.position:
-                    mode = curses.A_REVERSE
-                else:
-                    mode = curses.A_NORMAL
-
-                # Display the item.
-                self.addline(
-                    offset_top + row,
-                    item.label,
-                    mode,
-                )
-
-                row += 1
-
-            # Blank bottom lines if screen was resized
-            for y in range(offset_bottom):
-                self.addline(
-                    self.max_y - y - 1,
-                    '',
-                    curses.A_NORMAL,
-                )
-
-            # Because window.timeout was called,
-            # this returns -1 if nothing was pressed.
+            # This returns -1 if nothing was pressed before the timeout.
             key = self.window.getch()
 
             if key in [curses.KEY_ENTER, ord('\n')]:
-                return self.items[self.position].value
-            elif key in (curses.KEY_UP, ord('k')):
+                if self.items:
+                    return self.items[self.position].value
+            elif key == curses.KEY_UP or (key == ord('k') and self.query is None):
                 self.navigate(-1)
-            elif key in (curses.KEY_DOWN, ord('j')):
+            elif key == curses.KEY_DOWN or (key == ord('j') and self.query is None):
                 self.navigate(1)
+            elif key == curses.KEY_PPAGE:
+                self.move_to(self.position - self.page_height())
+            elif key == curses.KEY_NPAGE:
+                self.move_to(self.position + self.page_height())
+            elif key == curses.KEY_HOME:
+                self.move_to(0)
+            elif key == curses.KEY_END:
+                self.move_to(len(self.items) - 1)
+            elif self.query is not None:
+                if key == _escape_key:
+                    # Show every item again, keeping the selected one.
+                    selected = self.items[self.position] if self.items else None
+                    self.filter(None)
+                    if selected is not None:
+                        self.position = self.items.index(selected)
+                elif key in _backspace_keys:
+                    self.filter(self.query[:-1])
+                elif 32 <= key < 127:
+                    self.filter(self.query + chr(key))
+            elif key == ord('/'):
+                self.filter('')
             elif key in (ord('q'), ord('Q')):
                 raise KeyboardInterrupt
 
@@ -168,9 +374,12 @@ class Menu(object):
         curses.doupdate()
 
 
-def _display(screen, items, title=None):
+def _display(screen, items, title=None, refresh=None, refreshing=None):
     curses.curs_set(0)
-    menu = Menu(title, items, screen)
+    if hasattr(curses, 'set_escdelay'):
+        # Leave search mode straight away when Escape is pressed.
+        curses.set_escdelay(25)
+    menu = Menu(title, items, screen, refresh=refresh, refreshing=refreshing)
     return menu.display()
 
 
@@ -197,7 +406,7 @@ def _find_each_column_width(table):
     return columns_size
 
 
-def choose_instance(instances, search, show_menu=True):
+def _instance_items(instances, search):
 
     labels = [ec2.label(inst) for inst in instances]
     columns_width = _find_each_column_width(labels)
@@ -210,8 +419,41 @@ def choose_instance(instances, search, show_menu=True):
     if search:
         search = search.lower()
         items = [item for item in items if search in item.label.lower()]
-        if len(items) == 1:
-            return items[0].value
+
+    return items
+
+
+def matching_instances(instances, search):
+    """
+    Returns the instances that match the search string,
+    in the order they would be shown in the menu.
+
+    """
+
+    return [item.value for item in _instance_items(instances, search)]
+
+
+def choose_instance(instances, search, show_menu=True, refresh=None, refreshing=None):
+    """
+    Returns the chosen instance. If a refresh function is provided, it is
+    called to get updated instances while the menu is being displayed.
+    If a refreshing function is also provided, the refresh function is
+    only called while it returns True.
+
+    """
+
+    items = _instance_items(instances, search)
+
+    if refresh and not (show_menu and items and not (search and len(items) == 1)):
+        # The choice will be made without displaying the menu,
+        # so wait for possibly stale instances to be refreshed.
+        instances = refresh(wait=True)
+        if instances is not None:
+            items = _instance_items(instances, search)
+        refresh = None
+
+    if search and len(items) == 1:
+        return items[0].value
 
     if not items:
         return None
@@ -227,4 +469,12 @@ def choose_instance(instances, search, show_menu=True):
             )
         return items[0].value
 
-    return curses.wrapper(_display, items)
+    if refresh:
+        def refresh_items():
+            instances = refresh()
+            if instances is not None:
+                return _instance_items(instances, search)
+    else:
+        refresh_items = None
+
+    return curses.wrapper(_display, items, refresh=refresh_items, refreshing=refreshing)
@@ -2,13 +2,10 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import copy
-import hcl
 import operator
 import os
 import re
 
-from distutils.version import StrictVersion
-
 from . import errors, __version__
 
 
@@ -49,6 +46,7 @@ def _find_settings_path(path):
 
 
 def _load(path):
+    import hcl
     try:
         with open(path) as settings_file:
             return hcl.load(settings_file)
@@ -64,6 +62,8 @@ def _validate_version(data):
     if version is None:
         return
 
+    from distutils.version import StrictVersion
+
     ssha_version = StrictVersion(__version__)
     requirements = version.split(',')
     for requirement in requirements:
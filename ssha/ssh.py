@@ -3,8 +3,36 @@ from __future__ import unicode_literals
 
 import errno
 import os
+import socket
+import stat
+import subprocess
+import tempfile
 
-from . import config
+from . import config, errors
+
+
+_runtime = {}
+
+# The exit code of ssh when it fails to connect. Remote commands
+# can also exit with this, so it doesn't always mean that.
+connection_error_exit_code = 255
+
+# Seconds to wait when checking that ssh can connect.
+_check_timeout = 10
+
+# The error from ssh when it can't check a host key without prompting.
+_host_key_error = 'Host key verification failed'
+
+
+def _exit_code(status):
+    """
+    Returns the exit code from a process status.
+
+    """
+
+    if os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return 1
 
 
 def _get_address(instance_ip):
@@ -22,42 +50,149 @@ def _get_address(instance_ip):
         return instance_ip
 
 
-def connect(instance, bastion, command):
+def _clean_control_sockets(directory):
+    """
+    Removes control sockets left behind by master connections that
+    have exited. Connecting to a dead socket is refused straight away.
 
-    bastion_hostname = config.get('bastion.hostname')
-    if not bastion_hostname and bastion:
-        bastion_hostname = get_ip(bastion, connect_through_bastion=False)
-    if bastion_hostname:
-        config.add('bastion.address', _get_address(bastion_hostname))
+    """
 
-    instance_ip = get_ip(instance, connect_through_bastion=bool(bastion_hostname))
-    config.add('hostname', instance_ip)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                continue
+        except OSError:
+            continue
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            client.connect(path)
+        except socket.error as error:
+            if error.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        finally:
+            client.close()
 
-    instance_address = _get_address(instance_ip)
-    config.add('address', instance_address)
 
-    ssh_command = ['ssh']
-    if config.get('verbose'):
-        ssh_command += ['-v']
-    user_known_hosts_file = config.get('ssh.user_known_hosts_file')
-    if user_known_hosts_file:
-        ssh_command += ['-o', 'UserKnownHostsFile={}'.format(user_known_hosts_file)]
-    if bastion_hostname:
-        proxy_command = config.get('ssh.proxy_command')
-        ssh_command += ['-o', 'ProxyCommand={}'.format(proxy_command)]
-    ssh_command += [instance_address]
-    config.add('ssh.cmd', format_command(ssh_command))
+def _runtime_directory():
+    """
+    Returns a directory, only accessible by the current user,
+    for SSH control sockets. Dead sockets are removed the first
+    time this is called.
+
+    """
+
+    if 'directory' not in _runtime:
+
+        base = os.environ.get('XDG_RUNTIME_DIR')
+        if base:
+            directory = os.path.join(base, 'ssha')
+        else:
+            directory = os.path.join(tempfile.gettempdir(), 'ssha-{}'.format(os.getuid()))
+
+        try:
+            os.mkdir(directory, 0o700)
+        except OSError as error:
+            if error.errno != errno.EEXIST:
+                raise
+
+        # Other users could create the directory first in a shared
+        # temp directory, so make sure that it is safe to use.
+        info = os.lstat(directory)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+            errors.string_exit(
+                'Cannot use {} for SSH control sockets, it must be a directory only accessible by you'.format(directory)
+            )
+
+        _clean_control_sockets(directory)
+        _runtime['directory'] = directory
+
+    return _runtime['directory']
+
+
+def check(instance, bastion):
+    """
+    Returns True if ssh can connect to an instance and log in, without
+    prompting for anything. Only a trivial command is run on it.
+
+    """
+
+    return run_check(prepare_check(instance, bastion))
+
+
+def prepare_check(instance, bastion):
+    """
+    Returns the ssh command for checking that ssh can log in to an
+    instance. Preparing uses the global config, so run_check can then
+    run several of these at the same time.
+
+    """
+
+    ssh_command = prepare(instance, bastion)
+    return ssh_command[:-1] + [
+        '-o', 'BatchMode=yes',
+        '-o', 'ConnectTimeout={}'.format(_check_timeout),
+        ssh_command[-1],
+        'true',
+    ]
+
+
+def run_check(ssh_command):
+    """
+    Runs a command from prepare_check and returns True if it could log in.
+    An unknown host key also counts, because ssh prompts to accept it
+    when connecting, and running the SSM document again wouldn't help.
+
+    """
+
+    with open(os.devnull, 'r+') as devnull:
+        process = subprocess.Popen(ssh_command, stdin=devnull, stdout=devnull, stderr=subprocess.PIPE)
+        error_output = process.communicate()[1]
+    if process.returncode != connection_error_exit_code:
+        return True
+    return _host_key_error in error_output.decode('utf-8', 'replace')
+
+
+def connect(instance, bastion, command):
+
+    ssh_command = prepare(instance, bastion)
 
     if command:
 
         command = config.render(command)
         print('[ssha] running {}'.format(command))
-        return os.system(command)
+        return _exit_code(os.system(command))
 
     else:
 
         print('[ssha] running {}'.format(config.get('ssh.cmd')))
-        run(ssh_command)
+        return run(ssh_command)
+
+
+def control_options(proxy_command=False):
+    """
+    Returns ssh options for sharing connections to the same host
+    between ssh processes, if enabled with ssh.multiplex.
+
+    """
+
+    if not config.get('ssh.multiplex'):
+        return []
+
+    control_path = os.path.join(_runtime_directory(), '%C')
+    if proxy_command:
+        # ssh expands tokens in the ProxyCommand, and doesn't
+        # support %C there, so escape it for the inner ssh.
+        control_path = control_path.replace('%', '%%')
+
+    return [
+        '-o', 'ControlMaster=auto',
+        '-o', 'ControlPath={}'.format(control_path),
+        '-o', 'ControlPersist={}'.format(config.get('ssh.control_persist') or '10m'),
+    ]
 
 
 def format_command(command):
@@ -76,14 +211,55 @@ def get_ip(instance, connect_through_bastion):
     return instance.get('PublicIpAddress') or instance['PrivateIpAddress']
 
 
+def prepare(instance, bastion):
+    """
+    Sets the config values for connecting to an instance, such as
+    ssh.cmd and address, and returns the ssh command to run.
+
+    """
+
+    bastion_hostname = config.get('bastion.hostname')
+    if not bastion_hostname and bastion:
+        bastion_hostname = get_ip(bastion, connect_through_bastion=False)
+    if bastion_hostname:
+        config.add('bastion.address', _get_address(bastion_hostname))
+
+    instance_ip = get_ip(instance, connect_through_bastion=bool(bastion_hostname))
+    config.add('hostname', instance_ip)
+
+    instance_address = _get_address(instance_ip)
+    config.add('address', instance_address)
+
+    ssh_command = ['ssh']
+    if config.get('verbose'):
+        ssh_command += ['-v']
+    ssh_command += control_options()
+    user_known_hosts_file = config.get('ssh.user_known_hosts_file')
+    if user_known_hosts_file:
+        ssh_command += ['-o', 'UserKnownHostsFile={}'.format(user_known_hosts_file)]
+    if bastion_hostname:
+        proxy_command = config.get('ssh.proxy_command')
+        ssh_command += ['-o', 'ProxyCommand={}'.format(proxy_command)]
+    ssh_command += [instance_address]
+    config.add('ssh.cmd', format_command(ssh_command))
+
+    return ssh_command
+
+
 def run(command):
+    """
+    Runs a command in the foreground and returns its exit code.
+
+    """
+
+    status = 0
     child_pid = os.fork()
     if child_pid == 0:
         os.execlp(command[0], *command)
     else:
         while True:
             try:
-                os.waitpid(child_pid, 0)
+                _, status = os.waitpid(child_pid, 0)
             except OSError as error:
                 if error.errno == errno.ECHILD:
                     # No child processes.
@@ -96,3 +272,4 @@ def run(command):
                 else:
                     # An actual error occurred.
                     raise
+    return _exit_code(status)
@@ -0,0 +1,276 @@
+from __future__ import unicode_literals
+
+import fnmatch
+import glob
+import os
+import re
+
+from . import cache
+
+
+# Options that can be specified more than once,
+# where every value is used rather than the first.
+_multiple_value_options = (
+    'certificatefile',
+    'dynamicforward',
+    'identityfile',
+    'localforward',
+    'remoteforward',
+)
+
+# Matches "Keyword value" and "Keyword=value" lines.
+_line_pattern = re.compile(r'^\s*(\S+?)(?:\s*=\s*|\s+)(.*?)\s*$')
+
+# Matches percent tokens in option values.
+_token_pattern = re.compile(r'%(.)')
+
+# OpenSSH limits how deeply files can be included.
+_max_include_depth = 16
+
+
+class SSHConfig(object):
+    """
+    A parsed SSH config, indexed for looking up hosts. Blocks for exact
+    hostnames are found with a dict lookup, and other host patterns are
+    compiled into regular expressions.
+
+    Host blocks, Include directives (including inside Host blocks) and the
+    "all", "host" and "originalhost" Match criteria are supported. Blocks
+    using other Match criteria are never applied.
+
+    """
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.exact = {}
+        self.patterns = []
+
+        for index, block in enumerate(blocks):
+
+            conditions = block['conditions']
+            if len(conditions) == 1 and _is_exact(conditions[0]):
+                for negated, pattern in conditions[0]:
+                    self.exact.setdefault(pattern, []).append(index)
+            else:
+                compiled = [_compile_condition(condition) for condition in conditions]
+                self.patterns.append((index, compiled))
+
+    def lookup(self, hostname):
+        """
+        Returns the options for a hostname, with lowercase keys.
+        For each option the first value found is used, apart from
+        options such as IdentityFile which return a list of values.
+
+        """
+
+        indexes = list(self.exact.get(hostname, []))
+        for index, compiled in self.patterns:
+            if all(_condition_matches(condition, hostname) for condition in compiled):
+                indexes.append(index)
+
+        result = {}
+        for index in sorted(indexes):
+            for keyword, value in self.blocks[index]['options']:
+                if keyword in _multiple_value_options:
+                    result.setdefault(keyword, []).append(value)
+                elif keyword not in result:
+                    result[keyword] = value
+
+        if 'hostname' not in result:
+            result['hostname'] = hostname
+
+        for keyword in _multiple_value_options:
+            if keyword in result:
+                result[keyword] = [_expand_tokens(value, hostname, result) for value in result[keyword]]
+
+        return result
+
+
+def _compile_condition(condition):
+    positive = [fnmatch.translate(pattern) for negated, pattern in condition if not negated]
+    negative = [fnmatch.translate(pattern) for negated, pattern in condition if negated]
+    return (
+        re.compile('|'.join(positive)) if positive else None,
+        re.compile('|'.join(negative)) if negative else None,
+    )
+
+
+def _condition_matches(compiled, hostname):
+    positive, negative = compiled
+    if positive is None or not positive.match(hostname):
+        return False
+    if negative is not None and negative.match(hostname):
+        return False
+    return True
+
+
+def _expand_tokens(value, hostname, options):
+
+    def replace(match):
+        token = match.group(1)
+        if token == '%':
+            return '%'
+        elif token == 'd':
+            return os.path.expanduser('~')
+        elif token == 'h':
+            return options.get('hostname', hostname)
+        elif token == 'r':
+            return options.get('user', os.environ.get('USER', ''))
+        elif token == 'u':
+            return os.environ.get('USER', '')
+        return match.group(0)
+
+    return _token_pattern.sub(replace, value)
+
+
+def _files_unchanged(files):
+    for path, mtime in files.items():
+        if _mtime(path) != mtime:
+            return False
+    return True
+
+
+def _include_paths(value, files):
+    paths = []
+    for pattern in value.split():
+        pattern = os.path.expanduser(_unquote(pattern))
+        if not os.path.isabs(pattern):
+            pattern = os.path.join(os.path.expanduser('~/.ssh'), pattern)
+        # Track the directory so that added files are noticed.
+        directory = os.path.dirname(pattern)
+        files[directory] = _mtime(directory)
+        paths.extend(sorted(glob.glob(pattern)))
+    return paths
+
+
+def _is_exact(condition):
+    for negated, pattern in condition:
+        if negated or '*' in pattern or '?' in pattern:
+            return False
+    return bool(condition)
+
+
+def _match_condition(value):
+    """
+    Returns the host patterns for a Match line.
+
+    """
+
+    words = value.split()
+    if [word.lower() for word in words] == ['all']:
+        return [(False, '*')]
+    if len(words) == 2 and words[0].lower() in ('host', 'originalhost'):
+        return _patterns(_unquote(words[1]).split(','))
+    # Other criteria are not supported, so never match.
+    return []
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def _parse(path, conditions, blocks, files, depth):
+    """
+    Parses a config file into blocks of options, where each block
+    has the conditions that a hostname must match to use them.
+
+    """
+
+    files[path] = _mtime(path)
+    if files[path] is None:
+        return
+
+    block = {'conditions': conditions, 'options': []}
+    blocks.append(block)
+
+    with open(path) as open_file:
+        for line in open_file:
+
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+
+            match = _line_pattern.match(line)
+            if not match:
+                continue
+
+            keyword = match.group(1).lower()
+            value = match.group(2)
+
+            if keyword == 'host':
+                condition = _patterns(value.split())
+            elif keyword == 'match':
+                condition = _match_condition(value)
+            elif keyword == 'include':
+                if depth < _max_include_depth:
+                    for include_path in _include_paths(value, files):
+                        _parse(include_path, block['conditions'], blocks, files, depth + 1)
+                # Start a new block, so options after the Include
+                # keep their order relative to the included options.
+                condition = None
+            else:
+                block['options'].append((keyword, _unquote(value)))
+                continue
+
+            if condition is None:
+                block = {'conditions': block['conditions'], 'options': []}
+            else:
+                block = {'conditions': conditions + [condition], 'options': []}
+            blocks.append(block)
+
+
+def _patterns(words):
+    result = []
+    for word in words:
+        word = _unquote(word)
+        if word.startswith('!'):
+            result.append((True, word[1:]))
+        else:
+            result.append((False, word))
+    return result
+
+
+def _unquote(value):
+    if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+        return value[1:-1]
+    return value
+
+
+def load(path):
+    """
+    Returns the parsed config for a file. The parsed blocks are cached
+    on disk and reused until any of the files are changed.
+
+    """
+
+    cache_key = cache.key(path)
+
+    data, _ = cache.read('ssh_config', cache_key)
+    if data and _files_unchanged(data['files']):
+        return SSHConfig(data['blocks'])
+
+    blocks, files = parse(path)
+    cache.write('ssh_config', cache_key, {'blocks': blocks, 'files': files})
+    return SSHConfig(blocks)
+
+
+def parse(path):
+    """
+    Parses a config file, returning the blocks and the modification
+    times of the files that were read.
+
+    """
+
+    blocks = []
+    files = {}
+    _parse(path, [], blocks, files, depth=0)
+
+    # The top of the file applies to all hosts.
+    for block in blocks:
+        if not block['conditions']:
+            block['conditions'] = [[(False, '*')]]
+
+    return blocks, files
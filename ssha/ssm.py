@@ -2,12 +2,40 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import os
+import random
 import re
 import time
 
-from botocore.exceptions import ClientError
+from . import aws, cache, config, errors, ssh
 
-from . import aws, config, errors, ssh
+
+# describe_instance_information returns up to 50 results per page,
+# so filter by up to 50 instance IDs at a time to get one page each.
+# send_command also accepts up to 50 instance IDs per request.
+_instance_ids_per_request = 50
+
+# Command invocation statuses that are not finished yet.
+_pending_statuses = ('Pending', 'InProgress', 'Delayed')
+
+# Set on instances when discovery looked up their SSM information,
+# including instances that are not registered with SSM.
+looked_up_field = 'SSMLookedUp'
+
+# Command output included in list_command_invocations is limited
+# to this many characters, and ends with a marker if truncated.
+_listed_output_limit = 2500
+_truncated_marker = '---Output truncated---'
+
+# Separates standard output from error output in listed command output.
+_error_marker = '----------ERROR-------'
+
+# Errors from listing command invocations that are expected while
+# waiting: throttling, and new commands that are not visible yet.
+_retry_error_codes = ('InvalidCommandId', 'InvocationDoesNotExist', 'ThrottlingException')
+
+# Host keys files written during this run. They are added to after that,
+# so that instances in other regions can use the same file.
+_host_keys_files = set()
 
 
 def _send_command(instance_ids):
@@ -15,9 +43,13 @@ def _send_command(instance_ids):
     document_name = config.get('ssm.document.name')
     parameters = config.get('ssm.parameters')
 
+    if len(instance_ids) > 2:
+        instances = '{} instances'.format(len(instance_ids))
+    else:
+        instances = ' and '.join(instance_ids)
     print('[ssha] ssm send {document} to {instances}'.format(
         document=document_name,
-        instances=' and '.join(instance_ids),
+        instances=instances,
     ))
 
     ssm = aws.client('ssm')
@@ -36,84 +68,297 @@ def _send_command(instance_ids):
     return command_id
 
 
-def _wait_for_command(instance_ids, command_id):
+def _provisioned_key(instance_id):
+    """
+    Returns the cache key for the state of running the
+    current SSM document and parameters on an instance.
+
+    """
+
+    return cache.key(
+        aws.profile(),
+        config.get('aws.region_name'),
+        instance_id,
+        config.get('ssm.document.name'),
+        config.get('ssm.parameters'),
+    )
+
+
+def _find_executable(name):
+    """
+    Returns the path of an executable in the PATH, or None if it is not
+    found. Found paths are cached between runs, and checked before use.
+
+    """
+
+    path_env = os.environ.get('PATH', os.defpath)
+    cache_key = cache.key(name, path_env)
+
+    path, _ = cache.read('executables', cache_key)
+    if path and os.access(path, os.X_OK):
+        return path
+
+    for directory in path_env.split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            cache.write('executables', cache_key, path)
+            return path
+
+    return None
+
+
+def _get_outputs(commands, outputs):
+    """
+    Returns the output of finished commands for each instance.
+    The commands are a dict of {command_id: instance_ids}, and
+    outputs that were already found while waiting are reused.
+
+    """
+
+    import concurrent.futures
 
     ssm = aws.client('ssm')
 
+    invocations = []
+    for command_id, instance_ids in sorted(commands.items()):
+        for instance_id in instance_ids:
+            if outputs.get(instance_id) is None:
+                invocations.append((command_id, instance_id))
+
+    outputs = dict(outputs)
+    if not invocations:
+        return outputs
+
+    def get_output(invocation):
+        command_id, instance_id = invocation
+        result = ssm.get_command_invocation(
+            CommandId=command_id,
+            InstanceId=instance_id,
+        )
+        return result['StandardOutputContent']
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(invocations), 8)) as executor:
+        for (_, instance_id), output in zip(invocations, executor.map(get_output, invocations)):
+            outputs[instance_id] = output
+    return outputs
+
+
+def _invocation_output(result):
+    """
+    Returns the standard output from a command invocation listed with
+    details, or None if it could be incomplete: when the document has
+    several steps, when there was error output, or when it was truncated.
+
+    """
+
+    plugins = result.get('CommandPlugins') or []
+    if len(plugins) != 1:
+        return None
+    output = plugins[0].get('Output') or ''
+    if len(output) >= _listed_output_limit or _truncated_marker in output or _error_marker in output:
+        return None
+    return output
+
+
+def _wait_for_command(commands, details=False):
+    """
+    Waits for commands to finish on all instances. The commands are a
+    dict of {command_id: instance_ids}. The status of every instance is
+    checked with one API call per command, with an increasing delay
+    between calls. Exits if a command fails or takes too long.
+
+    Returns a dict of {instance_id: output}. If details is set, this has
+    the output included in the listed invocations, or None if it needs
+    to be fetched with _get_outputs.
+
+    """
+
+    from botocore.exceptions import ClientError
+
+    ssm = aws.client('ssm')
+    paginator = ssm.get_paginator('list_command_invocations')
+
+    timeout = config.get('ssm.timeout') or 300
+    deadline = time.time() + timeout
+
+    remaining = dict((command_id, set(instance_ids)) for command_id, instance_ids in commands.items())
     outputs = {}
+    delay = 0.25
 
-    for instance_id in instance_ids:
+    while remaining:
+
+        if time.time() > deadline:
+            instance_ids = set()
+            for pending_ids in remaining.values():
+                instance_ids.update(pending_ids)
+            errors.string_exit('Timed out after {} seconds waiting for ssm command on {}'.format(
+                timeout,
+                ' and '.join(sorted(instance_ids)),
+            ))
 
-        result = {'Status': 'Pending'}
+        # Sleep for between half and all of the delay, so that
+        # concurrent runs don't all call the API at the same time.
+        time.sleep(delay / 2 + random.uniform(0, delay / 2))
+        delay = min(delay * 2, 4)
+
+        for command_id, pending_ids in sorted(remaining.items()):
 
-        while result['Status'] in ('Pending', 'InProgress', 'Delayed'):
-            time.sleep(0.25)
             try:
-                result = ssm.get_command_invocation(
-                    CommandId=command_id,
-                    InstanceId=instance_id,
-                )
-            except ClientError:
-                pass
+                for page in paginator.paginate(CommandId=command_id, Details=details):
+                    for result in page['CommandInvocations']:
+
+                        instance_id = result['InstanceId']
+                        if instance_id not in pending_ids or result['Status'] in _pending_statuses:
+                            continue
 
-        if result['Status'] != 'Success':
-            errors.json_exit(result)
+                        if result['Status'] != 'Success':
+                            # Get the full details, including the error output.
+                            errors.json_exit(ssm.get_command_invocation(
+                                CommandId=command_id,
+                                InstanceId=instance_id,
+                            ))
 
-        print('[ssha] ssm command finished on {}'.format(instance_id))
-        outputs[instance_id] = result['StandardOutputContent']
+                        print('[ssha] ssm command finished on {}'.format(instance_id))
+                        pending_ids.remove(instance_id)
+                        outputs[instance_id] = _invocation_output(result) if details else None
+
+            except ClientError as error:
+                if error.response['Error']['Code'] not in _retry_error_codes:
+                    raise
+
+            if not pending_ids:
+                del remaining[command_id]
 
     return outputs
 
 
-def find_instances():
+def find_instances(client=None, instance_ids=None):
+    """
+    Returns SSM instance information, for all instances
+    or only for the specified instance IDs.
 
-    ssm = aws.client('ssm')
+    """
+
+    ssm = client or aws.client('ssm')
     paginator = ssm.get_paginator('describe_instance_information')
-    page_iterator = paginator.paginate()
+
+    if instance_ids is None:
+        requests = [{}]
+    else:
+        instance_ids = sorted(set(instance_ids))
+        requests = []
+        for index in range(0, len(instance_ids), _instance_ids_per_request):
+            batch = instance_ids[index:index + _instance_ids_per_request]
+            requests.append({
+                'Filters': [{'Key': 'InstanceIds', 'Values': batch}],
+            })
 
     instance_info_list = []
-    for page in page_iterator:
-        if page['ResponseMetadata']['HTTPStatusCode'] != 200:
-            errors.json_exit(page)
+    for kwargs in requests:
+        page_iterator = paginator.paginate(MaxResults=50, **kwargs)
+        for page in page_iterator:
+            if page['ResponseMetadata']['HTTPStatusCode'] != 200:
+                errors.json_exit(page)
 
-        instance_info_list += page['InstanceInformationList']
+            instance_info_list += page['InstanceInformationList']
 
     return instance_info_list
 
 
 def send_command(instance, bastion):
+    return send_commands([(instance, bastion)])
 
-    instance_ids = [inst['InstanceId'] for inst in (instance, bastion) if inst]
 
-    command_id = _send_command(
-        instance_ids=instance_ids,
-    )
+def forget_provisioned(instance_ids):
+    """
+    Forgets that the SSM document was run on instances,
+    so that it runs again next time.
 
-    outputs = _wait_for_command(
-        instance_ids=instance_ids,
-        command_id=command_id,
-    )
+    """
+
+    for instance_id in instance_ids:
+        cache.delete('provisioned', _provisioned_key(instance_id))
 
-    host_keys_file = config.get('ssm.host_keys_file')
-    if host_keys_file:
-        instance_ips = {}
 
+def send_commands(connections):
+    """
+    Runs the SSM document on instances, and their bastions, before
+    connecting to them. The connections are a list of (instance, bastion)
+    tuples. Instances are sent the command in batches, the batches are
+    waited on together, and the host keys of every instance are written
+    to one file.
+
+    If ssm.provision_ttl is set, instances that successfully ran the same
+    document and parameters within that many seconds are skipped.
+    Returns the IDs of the skipped instances.
+
+    """
+
+    # The IP address that ssh will use for each instance.
+    instance_ips = {}
+    for instance, bastion in connections:
         if bastion:
-            instance_id = bastion['InstanceId']
-            instance_ips[instance_id] = ssh.get_ip(bastion, connect_through_bastion=False)
+            instance_ips[bastion['InstanceId']] = ssh.get_ip(bastion, connect_through_bastion=False)
+        instance_ips[instance['InstanceId']] = ssh.get_ip(instance, connect_through_bastion=bool(bastion))
 
-        instance_id = instance['InstanceId']
-        instance_ips[instance_id] = ssh.get_ip(instance, connect_through_bastion=bool(bastion))
+    instance_ids = sorted(instance_ips)
+    host_keys_file = config.get('ssm.host_keys_file')
+    provision_ttl = config.get('ssm.provision_ttl')
 
-        with open(host_keys_file, 'w') as open_file:
-            for instance_id, ip in instance_ips.items():
-                host_keys = outputs[instance_id]
-                for line in host_keys.splitlines():
+    # Use the saved host keys of skipped instances, so
+    # instances without saved host keys can't be skipped.
+    outputs = {}
+    if provision_ttl:
+        for instance_id in instance_ids:
+            state, age = cache.read('provisioned', _provisioned_key(instance_id))
+            if state is None or age >= provision_ttl:
+                continue
+            if host_keys_file and state.get('host_keys') is None:
+                continue
+            outputs[instance_id] = state.get('host_keys')
+
+    skipped = sorted(outputs)
+    if skipped:
+        print('[ssha] ssm document already run on {}'.format(
+            '{} instances'.format(len(skipped)) if len(skipped) > 2 else ' and '.join(skipped),
+        ))
+
+    pending_ids = [instance_id for instance_id in instance_ids if instance_id not in outputs]
+    if pending_ids:
+
+        commands = {}
+        for index in range(0, len(pending_ids), _instance_ids_per_request):
+            batch = pending_ids[index:index + _instance_ids_per_request]
+            commands[_send_command(instance_ids=batch)] = batch
+
+        # The output is listed while waiting, so it
+        # only needs to be fetched if it was truncated.
+        command_outputs = _wait_for_command(commands, details=bool(host_keys_file))
+
+        if host_keys_file:
+            outputs.update(_get_outputs(commands, command_outputs))
+
+        if provision_ttl:
+            for instance_id in pending_ids:
+                cache.write('provisioned', _provisioned_key(instance_id), {
+                    'host_keys': outputs.get(instance_id),
+                })
+
+    if host_keys_file:
+
+        mode = 'a' if host_keys_file in _host_keys_files else 'w'
+        _host_keys_files.add(host_keys_file)
+
+        with open(host_keys_file, mode) as open_file:
+            for instance_id in instance_ids:
+                for line in outputs[instance_id].splitlines():
                     # Replace hostname from the host keys line
                     # with the instance's hostname.
-                    line = re.sub(r'^[^#\s]+', ip, line)
+                    line = re.sub(r'^[^#\s]+', instance_ips[instance_id], line)
                     open_file.write(line + '\n')
 
+    return skipped
+
 
 def session_manager_enabled(instance):
 
@@ -121,16 +366,22 @@ def session_manager_enabled(instance):
     if not config.get('ssm.session_manager', False):
         return False
 
-    # Check if agent is installed.
-    ssm = aws.client('ssm')
-    instance_metadata = ssm.describe_instance_information(InstanceInformationFilterList=[{'key': 'InstanceIds', 'valueSet': [instance['InstanceId']]}])['InstanceInformationList']
+    # Check if agent is installed. Discovery adds the SSM information
+    # to instances when Session Manager is enabled, so this only needs
+    # to look it up for instances that discovery didn't check.
+    if 'AgentVersion' in instance:
+        instance_metadata = [instance]
+    elif instance.get(looked_up_field):
+        instance_metadata = []
+    else:
+        instance_metadata = find_instances(instance_ids=[instance['InstanceId']])
 
     if len(instance_metadata) != 0:
         if not instance_metadata[0].get('AgentVersion'):
             return False
 
     # Check if required plugin is installed.
-    if os.system('which session-manager-plugin > /dev/null') != 0:
+    if not _find_executable('session-manager-plugin'):
         return False
 
     return True
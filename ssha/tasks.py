@@ -0,0 +1,144 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+
+class Graph(object):
+    """
+    Runs startup tasks, either in the current thread or concurrently in a
+    thread pool, with each task waiting for the tasks that it depends on.
+    The start and end times of tasks are recorded for tracing.
+
+    """
+
+    def __init__(self, max_workers=8):
+        self.max_workers = max_workers
+        self.origin = time.time()
+        self.tasks = {}
+        self.order = []
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _add(self, name, deps):
+        for dep in deps:
+            if dep not in self.tasks:
+                raise ValueError('Task {} depends on unknown task {}'.format(name, dep))
+        task = {'name': name, 'deps': tuple(deps), 'start': None, 'end': None}
+        with self._lock:
+            self.tasks[name] = task
+            self.order.append(name)
+        return task
+
+    def _call(self, task, func, args, kwargs):
+        for dep in task['deps']:
+            self.result(dep)
+        task['start'] = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            task['end'] = time.time()
+
+    def critical_path(self):
+        """
+        Returns the names of the tasks that determined when the last
+        task finished, following the dependency that finished last.
+
+        """
+
+        finished = [task for task in self.tasks.values() if task['end'] is not None]
+        if not finished:
+            return []
+
+        task = max(finished, key=lambda task: task['end'])
+        path = [task['name']]
+        while task['deps']:
+            task = max((self.tasks[dep] for dep in task['deps']), key=lambda task: task['end'] or 0)
+            path.append(task['name'])
+        return list(reversed(path))
+
+    def result(self, name):
+        """
+        Waits for a task to finish and returns its result.
+
+        """
+
+        task = self.tasks[name]
+        if 'future' in task:
+            return task['future'].result()
+        return task['result']
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Runs a task in the current thread and returns its result.
+
+        """
+
+        task = self._add(name, kwargs.pop('deps', ()))
+        task['result'] = self._call(task, func, args, kwargs)
+        return task['result']
+
+    def shutdown(self):
+        if self._executor:
+            self._executor.shutdown(wait=True)
+
+    def skip(self, name, reason):
+        """
+        Records a task that is not needed, so that tracing shows why
+        it didn't run rather than leaving it out.
+
+        """
+
+        task = self._add(name, ())
+        task['result'] = None
+        task['skipped'] = reason
+
+    def submit(self, name, func, *args, **kwargs):
+        """
+        Runs a task in the thread pool, after its dependencies finish.
+
+        """
+
+        if self._executor is None:
+            import concurrent.futures
+            # Tasks wait for their dependencies in the pool,
+            # so keep the pool bigger than the number of tasks.
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+
+        task = self._add(name, kwargs.pop('deps', ()))
+        task['future'] = self._executor.submit(self._call, task, func, args, kwargs)
+
+    def trace(self):
+        """
+        Prints when each task started and ended, in milliseconds
+        since the graph was created, and the critical path.
+
+        """
+
+        def milliseconds(seconds):
+            return int(round((seconds - self.origin) * 1000))
+
+        print('[ssha] trace:')
+        width = max(len(name) for name in self.order)
+        for name in self.order:
+            task = self.tasks[name]
+            if 'skipped' in task:
+                print('  {}  skipped ({})'.format(name.ljust(width), task['skipped']))
+                continue
+            if task['end'] is None:
+                continue
+            print('  {}  {:>6}ms -> {:>6}ms  ({}ms){}'.format(
+                name.ljust(width),
+                milliseconds(task['start']),
+                milliseconds(task['end']),
+                milliseconds(task['end']) - milliseconds(task['start']),
+                '  after ' + ', '.join(task['deps']) if task['deps'] else '',
+            ))
+
+        path = self.critical_path()
+        if path:
+            print('  critical path: {} ({}ms)'.format(
+                ' -> '.join(path),
+                milliseconds(self.tasks[path[-1]]['end']),
+            ))
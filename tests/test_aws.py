@@ -0,0 +1,142 @@
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from botocore.credentials import RefreshableCredentials
+from dateutil.tz import tzutc
+
+from ssha import aws, config, credential_cache, settings
+
+
+class StubResolver(object):
+
+    def __init__(self, expires_in):
+        self.expires_in = expires_in
+        self.calls = 0
+
+    def load_credentials(self):
+        self.calls += 1
+        return RefreshableCredentials.create_from_metadata(
+            metadata={
+                'access_key': 'AKIA{}'.format(self.calls),
+                'secret_key': 'secret',
+                'token': 'token',
+                'expiry_time': (datetime.datetime.now(tzutc()) + self.expires_in).isoformat(),
+            },
+            refresh_using=None,
+            method='assume-role',
+        )
+
+
+class TestAWS(unittest.TestCase):
+
+    def setUp(self):
+        # Reset the global settings, config and aws objects before each test.
+        settings.reset()
+        config.reset()
+        aws.reset()
+
+    def test_cached_credentials_profiles(self):
+        temp_dir = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        try:
+
+            # Two profiles for different accounts, using credential
+            # processes that return temporary credentials.
+            expiration = (datetime.datetime.now(tzutc()) + datetime.timedelta(hours=1)).isoformat()
+            config_path = os.path.join(temp_dir, 'config')
+            with open(config_path, 'w') as open_file:
+                for name in ('a', 'b'):
+                    output = (
+                        '{{"Version": 1, "AccessKeyId": "AKIA_ACCOUNT_{}", "SecretAccessKey": "secret",'
+                        ' "SessionToken": "token", "Expiration": "{}"}}'
+                    ).format(name.upper(), expiration)
+                    open_file.write("[profile {}]\ncredential_process = echo '{}'\n".format(name, output))
+
+            for name in list(os.environ):
+                if name.startswith('AWS_'):
+                    del os.environ[name]
+            os.environ['AWS_CONFIG_FILE'] = config_path
+            os.environ['AWS_SHARED_CREDENTIALS_FILE'] = os.path.join(temp_dir, 'credentials')
+            os.environ['XDG_CACHE_HOME'] = os.path.join(temp_dir, 'cache')
+            config.add('aws.region_name', 'eu-west-1')
+
+            # Profiles chosen with AWS_PROFILE don't share cached credentials.
+            for name in ('a', 'b', 'a'):
+                aws.reset()
+                os.environ['AWS_PROFILE'] = name
+                access_key = aws.credentials().get_frozen_credentials().access_key
+                self.assertEqual(access_key, 'AKIA_ACCOUNT_{}'.format(name.upper()))
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(temp_dir)
+
+    def test_client_pool(self):
+        config.add('aws.region_name', 'eu-west-1')
+
+        # Sessions and clients are reused.
+        self.assertIs(aws.session(), aws.session())
+        self.assertIs(aws.client('ec2'), aws.client('ec2'))
+        self.assertIsNot(aws.client('ec2'), aws.client('ssm'))
+        self.assertIsNot(aws.client('ec2'), aws.client('ec2', region_name='us-east-1'))
+
+        # Changing the aws config uses a different session.
+        session = aws.session()
+        config.add('aws.region_name', 'eu-central-1')
+        self.assertIsNot(aws.session(), session)
+        self.assertEqual(aws.client('ec2').meta.region_name, 'eu-central-1')
+
+    def test_client_pool_threads(self):
+        config.add('aws.region_name', 'eu-west-1')
+
+        clients = []
+
+        def get_client():
+            clients.append(aws.client('ec2'))
+
+        threads = [threading.Thread(target=get_client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(set(id(client) for client in clients)), 1)
+
+    def test_cached_credentials(self):
+        cache_home = tempfile.mkdtemp()
+        environ = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = cache_home
+        try:
+
+            # The first provider resolves and caches the credentials.
+            resolver = StubResolver(expires_in=datetime.timedelta(hours=1))
+            provider = credential_cache.CachedCredentialProvider(resolver, 'key')
+            creds = provider.load()
+            self.assertEqual(resolver.calls, 1)
+            self.assertEqual(creds.method, 'assume-role')
+            self.assertEqual(creds.get_frozen_credentials().access_key, 'AKIA1')
+
+            # Another run uses the cached credentials.
+            resolver = StubResolver(expires_in=datetime.timedelta(hours=1))
+            creds = credential_cache.CachedCredentialProvider(resolver, 'key').load()
+            self.assertEqual(resolver.calls, 0)
+            self.assertEqual(creds.method, 'assume-role')
+            self.assertEqual(creds.get_frozen_credentials().access_key, 'AKIA1')
+
+            # Credentials that are close to expiring are resolved again.
+            resolver = StubResolver(expires_in=datetime.timedelta(minutes=12))
+            credential_cache.CachedCredentialProvider(resolver, 'other').load()
+            creds = credential_cache.CachedCredentialProvider(resolver, 'other').load()
+            self.assertEqual(resolver.calls, 2)
+
+        finally:
+            if environ is None:
+                del os.environ['XDG_CACHE_HOME']
+            else:
+                os.environ['XDG_CACHE_HOME'] = environ
+            shutil.rmtree(cache_home)
@@ -0,0 +1,67 @@
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from dateutil.tz import tzutc
+
+from ssha import cache, config, settings
+
+
+class TestCache(unittest.TestCase):
+
+    def setUp(self):
+        # Reset the global settings and config objects before each test,
+        # and use a temporary directory for the cache files.
+        settings.reset()
+        config.reset()
+        self.cache_home = tempfile.mkdtemp()
+        self.environ = os.environ.get('XDG_CACHE_HOME')
+        os.environ['XDG_CACHE_HOME'] = self.cache_home
+
+    def tearDown(self):
+        if self.environ is None:
+            del os.environ['XDG_CACHE_HOME']
+        else:
+            os.environ['XDG_CACHE_HOME'] = self.environ
+        shutil.rmtree(self.cache_home)
+
+    def test_read_write(self):
+        key = cache.key('profile', 'eu-west-1', 'dev')
+
+        # Missing values return nothing.
+        self.assertEqual(cache.read('instances', key), (None, None))
+
+        # Values are returned with their age, including datetimes.
+        launch_time = datetime.datetime(2019, 1, 2, 3, 4, 5, tzinfo=tzutc())
+        cache.write('instances', key, [{'InstanceId': 'abc', 'LaunchTime': launch_time}])
+        value, age = cache.read('instances', key)
+        self.assertEqual(value, [{'InstanceId': 'abc', 'LaunchTime': launch_time}])
+        self.assertLess(age, 60)
+
+        # Cache files are private.
+        mode = os.stat(cache._path('instances', key)).st_mode
+        self.assertEqual(stat.S_IMODE(mode), 0o600)
+
+        # Different keys don't share values.
+        self.assertEqual(cache.read('instances', cache.key('profile', 'eu-west-1', 'prod')), (None, None))
+
+    def test_disabled(self):
+        key = cache.key('test')
+        cache.write('instances', key, ['abc'])
+        config.add('cache.disabled', True)
+        self.assertEqual(cache.read('instances', key), (None, None))
+
+    def test_take(self):
+        cache.write('pool', 'one', 1)
+        cache.write('pool', 'two', 2)
+        self.assertEqual(cache.names('pool'), ['one', 'two'])
+
+        # Taken values are removed.
+        value, age = cache.take('pool', 'one')
+        self.assertEqual(value, 1)
+        self.assertEqual(cache.take('pool', 'one'), (None, None))
+        self.assertEqual(cache.names('pool'), ['two'])
+        self.assertEqual(cache.names('missing'), [])
@@ -0,0 +1,75 @@
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+from ssha import cli, config, ec2, settings
+
+
+SETTINGS = '''
+ssha {
+  configs = ["dev"]
+  regions = ["eu-west-1", "us-east-1"]
+}
+
+config dev {
+  aws {
+    region_name = "eu-west-1"
+  }
+}
+'''
+
+
+class TestCLI(unittest.TestCase):
+
+    def setUp(self):
+        # Reset the global settings and config objects before each test,
+        # use a temporary directory for the settings and cache files, and
+        # replace instance discovery with stubs.
+        settings.reset()
+        config.reset()
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = self.temp_dir
+        self.settings_path = os.path.join(self.temp_dir, '.ssha')
+        with open(self.settings_path, 'w') as open_file:
+            open_file.write(SETTINGS)
+        self.start_discovery = ec2.start_discovery
+        self.discover_instances = ec2.discover_instances
+        ec2.start_discovery = lambda wait: None
+        ec2.discover_instances = lambda wait: ec2._regions()
+
+    def tearDown(self):
+        ec2.start_discovery = self.start_discovery
+        ec2.discover_instances = self.discover_instances
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.temp_dir)
+
+    def startup(self, **kwargs):
+        args = argparse.Namespace(
+            all_regions=False,
+            command=None,
+            config='dev',
+            explain_config=False,
+            refresh=False,
+            region=None,
+            settings=self.settings_path,
+            trace=False,
+            verbose=False,
+        )
+        for name, value in kwargs.items():
+            setattr(args, name, value)
+        return cli._startup(args)
+
+    def test_all_regions_overrides_config_region(self):
+        self.assertEqual(self.startup(), ['eu-west-1'])
+
+        settings.reset()
+        config.reset()
+        self.assertEqual(self.startup(all_regions=True), ['eu-west-1', 'us-east-1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
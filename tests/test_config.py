@@ -1,3 +1,7 @@
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 from ssha import config, settings
@@ -6,9 +10,18 @@ from ssha import config, settings
 class TestConfig(unittest.TestCase):
 
     def setUp(self):
-        # Reset the global settings and config objects before each test.
+        # Reset the global settings and config objects before each test,
+        # and use a temporary directory for the cache files.
         settings.reset()
         config.reset()
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = self.temp_dir
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.temp_dir)
 
     def test_add(self):
         # Add a simple top-level value.
@@ -52,3 +65,99 @@ class TestConfig(unittest.TestCase):
         self.assertEqual(config.get('value1'), None)
         self.assertEqual(config.get('value2'), None)
         self.assertEqual(config.get('value3'), 'c')
+
+    def test_render(self):
+        config.update({
+            'a': 'A',
+            'b': '${a}-${a}',
+            'c': {'d': ['${b}', 'e']},
+        })
+        self.assertEqual(config.get('b'), 'A-A')
+        self.assertEqual(config.get('c'), {'d': ['A-A', 'e']})
+        self.assertEqual(config.render('${b}!'), 'A-A!')
+
+        # Rendered values are not changed by callers.
+        config.get('c')['d'].append('f')
+        self.assertEqual(config.get('c.d'), ['A-A', 'e'])
+
+        # Rendered values are updated when the config changes.
+        config.add('a', 'Z')
+        self.assertEqual(config.get('b'), 'Z-Z')
+        self.assertEqual(config.get('c.d'), ['Z-Z', 'e'])
+
+        # Missing variables are errors.
+        config.add('b', '${missing}')
+        self.assertRaises(KeyError, config.get, 'b')
+
+    def test_render_commands(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'count')
+            config.update({
+                'one': '$(echo run >> {} && echo output)'.format(path),
+                'two': '${one}',
+            })
+            self.assertEqual(config.get('one'), 'output')
+            self.assertEqual(config.get('two'), 'output')
+
+            # Commands still only run once after the config changes.
+            config.add('three', 'value')
+            self.assertEqual(config.get('two'), 'output')
+
+            with open(path) as open_file:
+                self.assertEqual(open_file.read(), 'run\n')
+        finally:
+            shutil.rmtree(temp_dir)
+
+    def test_render_cycle(self):
+        config.update({
+            'a': '${b}',
+            'b': 'x-${c}',
+            'c': '${b}',
+        })
+        with self.assertRaises(SystemExit):
+            config.get('a')
+
+    def test_variables(self):
+        config.update({
+            'a': '${x}',
+            'b': {'c': ['${x}', '${y}']},
+        })
+        self.assertTrue(config.is_used_as_variable('x'))
+        self.assertEqual(config.variables(), {'x': ['a', 'b.c'], 'y': ['b.c']})
+
+        # Replacing values updates the index.
+        config.add('b.c', 'none')
+        self.assertFalse(config.is_used_as_variable('y'))
+        config.add('b', '${z}')
+        self.assertEqual(config.variables(), {'x': ['a'], 'z': ['b']})
+
+        # Settings for other configs do not count.
+        config.reset()
+        settings.update({
+            'ssha': {'configs': ['one', 'two']},
+            'config': {'two': {'key': '${ssm.host_keys_file}'}},
+        })
+        config.load('one')
+        self.assertFalse(config.is_used_as_variable('ssm.host_keys_file'))
+        self.assertEqual(config.get('ssm.host_keys_file'), None)
+
+    def test_deferred(self):
+        event = threading.Event()
+
+        def slow_value():
+            event.wait()
+            return 'ready'
+
+        config.add('ssh.temporary_key', config._Deferred(slow_value))
+        config.add('ssm.parameters', {'key': ['${ssh.temporary_key}']})
+        event.set()
+        self.assertEqual(config.get('ssm.parameters'), {'key': ['ready']})
+        self.assertEqual(config.get('ssh'), {'temporary_key': 'ready'})
+
+        # Errors are reported when the value is used.
+        def failing_value():
+            raise RuntimeError('failed')
+
+        config.add('ssh.temporary_key', config._Deferred(failing_value))
+        self.assertRaises(SystemExit, config.get, 'ssh.temporary_key')
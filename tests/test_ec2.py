@@ -1,8 +1,65 @@
+import itertools
+import os
+import re
+import shutil
+import tempfile
 import unittest
 
 from ssha import config, ec2, settings
 
 
+def describe_instances(instances, filters):
+    """
+    Simulates how the EC2 API applies describe_instances filters.
+
+    """
+
+    fields = {
+        'availability-zone': ('Placement', 'AvailabilityZone'),
+        'image-id': ('ImageId',),
+        'instance-id': ('InstanceId',),
+        'instance-state-name': ('State', 'Name'),
+        'instance-type': ('InstanceType',),
+        'subnet-id': ('SubnetId',),
+        'vpc-id': ('VpcId',),
+    }
+
+    def matches(value, filter_values):
+        for filter_value in filter_values:
+            # Filter values support * and ? wildcards, escaped with \.
+            pattern = ''
+            for token in re.findall(r'\\.|.', filter_value):
+                if token == '*':
+                    pattern += '.*'
+                elif token == '?':
+                    pattern += '.'
+                else:
+                    pattern += re.escape(token[-1])
+            if isinstance(value, str) and re.match(pattern + r'\Z', value, re.DOTALL):
+                return True
+        return False
+
+    result = []
+    for instance in instances:
+        for name, values in filters.items():
+            if name == 'tag-key':
+                value = [key for key in instance['Tags'] if matches(key, values)]
+                if not value:
+                    break
+                continue
+            if name.startswith('tag:'):
+                value = instance['Tags'].get(name[len('tag:'):])
+            else:
+                value = instance
+                for key in fields[name]:
+                    value = value.get(key) or {}
+            if not matches(value, values):
+                break
+        else:
+            result.append(instance)
+    return result
+
+
 class TestEC2(unittest.TestCase):
 
     def setUp(self):
@@ -66,3 +123,400 @@ class TestEC2(unittest.TestCase):
         self.assertTrue(ec2._rules_pass(web_instance, is_not_bastion))
         self.assertFalse(ec2._rules_pass(web_instance, is_bastion))
         self.assertFalse(ec2._rules_pass(bastion_instance, is_not_bastion))
+
+    def test_ssm_candidates(self):
+        instances = [
+            {'InstanceId': 'i-1', 'Tags': {'Service': 'bastion'}},
+            {'InstanceId': 'i-2', 'Tags': {'Service': 'web'}},
+            {'InstanceId': 'i-3', 'Tags': {'Service': 'db'}},
+        ]
+        rule_sets = [{'Tags': {'Service': 'web'}}, {'Tags': {'Service': 'bastion'}}]
+        self.assertEqual(ec2._ssm_candidates(instances, rule_sets), ['i-1', 'i-2'])
+        self.assertEqual(ec2._ssm_candidates(instances, [{}]), ['i-1', 'i-2', 'i-3'])
+        self.assertEqual(ec2._ssm_candidates(instances, []), [])
+
+    def test_filter_push_down(self):
+
+        instances = []
+        for index, (state, service, environment, vpc) in enumerate(itertools.product(
+            ('running', 'stopped'),
+            ('bastion', 'web', '', None),
+            ('dev', 'prod*', None),
+            ('vpc-1', 'vpc-2', None),
+        )):
+            tags = {}
+            if service is not None:
+                tags['Service'] = service
+            if environment is not None:
+                tags['Environment'] = environment
+            instance = {
+                'InstanceId': 'i-{}'.format(index),
+                'State': {'Name': state},
+                'Placement': {'AvailabilityZone': 'eu-west-1a' if index % 2 else 'eu-west-1b'},
+                'Tags': tags,
+            }
+            if vpc:
+                instance['VpcId'] = vpc
+            instances.append(instance)
+
+        rule_sets = [
+            {},
+            {'State': {'Name': 'running'}},
+            {'State': {'Name': 'running'}, 'Tags': {'Environment': 'dev'}},
+            {'State': {'Name': 'running'}, 'Tags': {'Environment': 'prod*'}},
+            {'Tags': {'Service': ''}},
+            {'Tags': {'Service': 'web'}, 'TagsNotEqual': {'Environment': 'dev'}},
+            {'StateNotEqual': {'Name': 'stopped'}, 'VpcId': 'vpc-1'},
+            {'Placement': {'AvailabilityZone': 'eu-west-1a'}, 'Tags': {'Service': 'bastion'}},
+            {'State': {'Name': 'running'}, 'Tags': {'Service': 'bastion', 'Environment': 'dev'}, 'VpcId': 'vpc-2'},
+            {'TagsPrefix': {'Environment': 'pro'}, 'StateIn': {'Name': ['running', 'pending']}},
+            {'TagsPrefix': {'Environment': 'prod*'}, 'Tags': {'Service': 'web'}},
+            {'TagsGlob': {'Service': 'b*n'}, 'PlacementGlob': {'AvailabilityZone': '*-1?'}},
+            {'TagsRegex': {'Service': '^(web|bastion)$'}, 'TagsExists': {'Environment': True}},
+            {'TagsExists': {'Service': False, 'Environment': True}},
+            {'Tags': {'Service': 'web'}, 'TagsIn': {'Service': ['web', 'bastion']}},
+        ]
+
+        # Filters and remaining rules should match the same instances
+        # as checking all of the rules locally.
+        for rules in rule_sets:
+            filters, remaining = ec2._compile_filters(rules)
+            expected = ec2._filter_instances(instances, rules)
+            result = ec2._filter_instances(describe_instances(instances, filters), remaining)
+            self.assertEqual(result, expected, rules)
+
+        # Discovery and bastion rules share a listing,
+        # which must include the results of both.
+        for discover_rules, bastion_rules in itertools.product(rule_sets, repeat=2):
+            config.reset()
+            config.add('discover.ec2', discover_rules)
+            config.add('bastion.ec2', bastion_rules)
+            listing = describe_instances(instances, ec2._listing_filters())
+            for rules in (discover_rules, bastion_rules) if bastion_rules else (discover_rules,):
+                self.assertEqual(
+                    ec2._filter_instances(listing, rules),
+                    ec2._filter_instances(instances, rules),
+                )
+
+    def test_filter_push_down_bastion_hostname(self):
+        # A bastion with only a hostname doesn't need to be discovered,
+        # so it doesn't stop the discovery rules from being pushed down.
+        config.add('discover.ec2', {'State': {'Name': 'running'}})
+        config.add('bastion.hostname', 'bastion.example.com')
+        self.assertEqual(ec2._listing_filters(), {'instance-state-name': ['running']})
+
+        # A bastion with only SSM rules could be any instance.
+        config.add('bastion.ssm', {'PingStatus': 'Online'})
+        self.assertEqual(ec2._listing_filters(), {})
+
+    def test_filter_push_down_values(self):
+        filters, remaining = ec2._compile_filters({
+            'State': {'Name': 'running'},
+            'Tags': {'Name': 'web', 'Role': 'web*', 'Empty': ''},
+            'TagsNotEqual': {'Service': 'k8s'},
+            'TagsPrefix': {'Team': 'ops-', 'Name': 'w'},
+            'TagsGlob': {'Owner': '*@example.com', 'Project': '[ab]*'},
+            'TagsIn': {'Environment': ['dev', 'test']},
+            'TagsExists': {'Backup': True, 'Legacy': False},
+            'TagsRegex': {'Version': '^1\\.'},
+            'Monitoring': {'State': 'enabled'},
+        })
+        self.assertEqual(filters, {
+            'instance-state-name': ['running'],
+            'tag:Name': ['web'],
+            'tag:Team': ['ops-*'],
+            'tag:Owner': ['*@example.com'],
+            'tag:Environment': ['dev', 'test'],
+            'tag-key': ['Backup'],
+        })
+        self.assertEqual(remaining, {
+            'Tags': {'Role': 'web*', 'Empty': ''},
+            'TagsNotEqual': {'Service': 'k8s'},
+            'TagsPrefix': {'Name': 'w'},
+            'TagsGlob': {'Project': '[ab]*'},
+            'TagsExists': {'Legacy': False},
+            'TagsRegex': {'Version': '^1\\.'},
+            'Monitoring': {'State': 'enabled'},
+        })
+
+    def test_rule_operators(self):
+        instance = {
+            'InstanceType': 't3.micro',
+            'State': {'Name': 'running'},
+            'Tags': {'Name': 'web-1', 'Service': 'web'},
+        }
+        passing = [
+            {'TagsPrefix': {'Name': 'web-'}},
+            {'TagsGlob': {'Name': 'web-?'}},
+            {'TagsRegex': {'Name': r'-\d+$'}},
+            {'TagsIn': {'Service': ['api', 'web']}},
+            {'TagsExists': {'Name': True, 'Missing': False}},
+            {'StateNotEqual': {'Name': 'stopped'}},
+        ]
+        failing = [
+            {'TagsPrefix': {'Name': 'db-'}},
+            {'TagsPrefix': {'Missing': ''}},
+            {'TagsGlob': {'Name': 'web'}},
+            {'TagsRegex': {'Missing': '.*'}},
+            {'TagsIn': {'Service': ['api']}},
+            {'TagsExists': {'Name': False}},
+            {'TagsExists': {'Missing': True}},
+            {'State': {'Name': 'running'}, 'TagsIn': {'Service': []}},
+        ]
+        for rules in passing:
+            self.assertTrue(ec2._rules_pass(instance, rules), rules)
+        for rules in failing:
+            self.assertFalse(ec2._rules_pass(instance, rules), rules)
+
+        self.assertRaises(SystemExit, ec2._rules_pass, instance, {'TagsRegex': {'Name': '('}})
+
+    def test_all_regions(self):
+
+        class StubEC2(object):
+            def __init__(self, region_name):
+                self.region_name = region_name
+
+            def describe_instances(self, **kwargs):
+                if self.region_name in failing_regions:
+                    raise Exception('AuthFailure')
+                return {
+                    'ResponseMetadata': {'HTTPStatusCode': 200},
+                    'Reservations': [{'Instances': [
+                        {'InstanceId': 'i-' + self.region_name, 'Tags': [{'Key': 'Name', 'Value': 'web'}]},
+                    ]}],
+                }
+
+        def client(service_name, region_name=None):
+            return StubEC2(region_name)
+
+        failing_regions = []
+
+        config.add('cache.disabled', True)
+        config.add('discover.all_regions', True)
+        config.add('display.fields', ['Tags.Name'])
+        config.add('ssha.regions', ['eu-west-1', 'us-east-1'])
+
+        original_client = ec2.aws.client
+        ec2.aws.client = client
+        try:
+            instances = ec2.discover_instances()
+        finally:
+            ec2.aws.client = original_client
+            ec2._listings.clear()
+
+        # Instances from each region are merged and labelled with their region.
+        self.assertEqual([instance['InstanceId'] for instance in instances], ['i-eu-west-1', 'i-us-east-1'])
+        self.assertEqual(ec2.label(instances[0]), ['eu-west-1', 'web'])
+
+        # Regions that can't be listed are skipped.
+        failing_regions.append('us-east-1')
+        ec2.aws.client = client
+        try:
+            instances = ec2.discover_instances()
+        finally:
+            ec2.aws.client = original_client
+            ec2._listings.clear()
+        self.assertEqual([instance['InstanceId'] for instance in instances], ['i-eu-west-1'])
+
+        # Unless it is the only region.
+        config.add('discover.all_regions', False)
+        config.add('aws.region_name', 'us-east-1')
+        ec2.aws.client = client
+        try:
+            self.assertRaises(Exception, ec2.discover_instances)
+        finally:
+            ec2.aws.client = original_client
+            ec2._listings.clear()
+
+    def test_page_size_throttled(self):
+        sleep = ec2.time.sleep
+        ec2.time.sleep = lambda seconds: None
+        try:
+            page_size = ec2._PageSize(1000, adaptive=True)
+            for _ in range(page_size.max_retries):
+                self.assertTrue(page_size.throttled())
+            self.assertEqual(page_size.size, page_size.minimum)
+
+            # Throttled requests are retried a limited number of times,
+            # counting again after a request succeeds.
+            self.assertFalse(page_size.throttled())
+            page_size.update(0.5)
+            self.assertTrue(page_size.throttled())
+
+            self.assertFalse(ec2._PageSize(1000).throttled())
+        finally:
+            ec2.time.sleep = sleep
+
+    def test_cache_key_profile(self):
+        environ = dict(os.environ)
+        try:
+            os.environ.pop('AWS_DEFAULT_PROFILE', None)
+            os.environ.pop('AWS_ACCESS_KEY_ID', None)
+
+            # Accounts chosen with AWS_PROFILE don't share cached instances.
+            os.environ['AWS_PROFILE'] = 'a'
+            key_a = ec2._cache_key('eu-west-1', {}, [])
+            os.environ['AWS_PROFILE'] = 'b'
+            self.assertNotEqual(ec2._cache_key('eu-west-1', {}, []), key_a)
+            os.environ['AWS_PROFILE'] = 'a'
+            self.assertEqual(ec2._cache_key('eu-west-1', {}, []), key_a)
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def test_discover_bastion(self):
+
+        def instance(instance_id, service, vpc_id, subnet_id, availability_zone):
+            return {
+                'InstanceId': instance_id,
+                'Placement': {'AvailabilityZone': availability_zone},
+                'Region': 'eu-west-1',
+                'SubnetId': subnet_id,
+                'Tags': {'Service': service},
+                'VpcId': vpc_id,
+            }
+
+        bastion_a = instance('i-1', 'bastion', 'vpc-1', 'subnet-a', 'eu-west-1a')
+        bastion_b = instance('i-2', 'bastion', 'vpc-1', 'subnet-b', 'eu-west-1b')
+        bastion_c = instance('i-3', 'bastion', 'vpc-2', 'subnet-c', 'eu-west-1a')
+        web_a = instance('i-4', 'web', 'vpc-1', 'subnet-a', 'eu-west-1a')
+        web_b = instance('i-5', 'web', 'vpc-1', 'subnet-d', 'eu-west-1b')
+        web_c = instance('i-6', 'web', 'vpc-2', 'subnet-e', 'eu-west-1b')
+        web_d = instance('i-7', 'web', 'vpc-3', 'subnet-f', 'eu-west-1c')
+
+        config.add('aws.region_name', 'eu-west-1')
+        config.add('bastion.ec2', {'Tags': {'Service': 'bastion'}})
+        config.add('discover.ec2', {'TagsNotEqual': {'Service': 'bastion'}})
+
+        ec2._listings['eu-west-1'] = [bastion_a, bastion_b, bastion_c, web_a, web_b, web_c, web_d]
+        try:
+            self.assertEqual(ec2.discover_instances(), [web_a, web_b, web_c, web_d])
+
+            # Bastions in the same subnet, then zone, then VPC are preferred.
+            self.assertIs(ec2.discover_bastion(web_a), bastion_a)
+            self.assertIs(ec2.discover_bastion(web_b), bastion_b)
+            self.assertIs(ec2.discover_bastion(web_c), bastion_c)
+            self.assertIs(ec2.discover_bastion(web_d), bastion_a)
+
+            # Bastions don't need a bastion.
+            self.assertIsNone(ec2.discover_bastion(bastion_b))
+
+            # The instances are only split again when the listing changes.
+            targets = ec2._discover()['targets']
+            self.assertIs(ec2._discover()['targets'], targets)
+            ec2._listings['eu-west-1'] = [web_a]
+            self.assertEqual(ec2._discover()['targets'], [web_a])
+            self.assertRaises(SystemExit, ec2.discover_bastion, web_a)
+        finally:
+            ec2._listings.clear()
+
+    def test_probe_bastions(self):
+
+        instance = {'InstanceId': 'i-0', 'Region': 'eu-west-1', 'VpcId': 'vpc-1'}
+        bastions = [
+            {'InstanceId': 'i-{}'.format(index), 'PublicIpAddress': '10.0.0.{}'.format(index)}
+            for index in range(1, 5)
+        ]
+
+        latencies = {'10.0.0.1': None, '10.0.0.2': 0.2, '10.0.0.3': 0.1, '10.0.0.4': 0.01}
+        probed = []
+
+        def connect_time(address, port, timeout):
+            probed.append((address, port, timeout))
+            return latencies[address]
+
+        temp_dir = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = temp_dir
+        original_connect_time = ec2._connect_time
+        ec2._connect_time = connect_time
+        try:
+            config.add('bastion.probe_port', 2222)
+
+            # The fastest of the closest bastions is used.
+            self.assertIs(ec2._probe_bastions(instance, bastions), bastions[2])
+            self.assertEqual(sorted(probed), [
+                ('10.0.0.1', 2222, 1),
+                ('10.0.0.2', 2222, 1),
+                ('10.0.0.3', 2222, 1),
+            ])
+
+            # The result is cached for the VPC.
+            del probed[:]
+            self.assertIs(ec2._probe_bastions(instance, bastions), bastions[2])
+            self.assertEqual(probed, [])
+
+            # It is probed again when the cached bastion is gone.
+            self.assertIs(ec2._probe_bastions(instance, bastions[:2]), bastions[1])
+
+            # The closest bastion is used when none can be reached.
+            latencies['10.0.0.2'] = None
+            config.add('refresh', True)
+            self.assertIs(ec2._probe_bastions(instance, bastions[:2]), bastions[0])
+        finally:
+            ec2._connect_time = original_connect_time
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(temp_dir)
+
+    def test_ssm_instance_information(self):
+
+        class StubEC2(object):
+            def describe_instances(self, **kwargs):
+                instances = []
+                for index in range(120):
+                    service = 'web' if index % 2 else 'db'
+                    instances.append({
+                        'InstanceId': 'i-{}'.format(index),
+                        'Tags': [{'Key': 'Service', 'Value': service}],
+                    })
+                return {
+                    'ResponseMetadata': {'HTTPStatusCode': 200},
+                    'Reservations': [{'Instances': instances}],
+                }
+
+        class StubSSM(object):
+            def __init__(self):
+                self.requests = []
+
+            def get_paginator(self, operation_name):
+                return self
+
+            def paginate(self, MaxResults, Filters):
+                instance_ids = Filters[0]['Values']
+                self.requests.append(instance_ids)
+                yield {
+                    'ResponseMetadata': {'HTTPStatusCode': 200},
+                    'InstanceInformationList': [
+                        {'InstanceId': instance_id, 'PingStatus': 'Online'}
+                        for instance_id in instance_ids if instance_id != 'i-1'
+                    ],
+                }
+
+        config.add('cache.disabled', True)
+        ssm_client = StubSSM()
+        instances = ec2._list_instances(
+            region_name='eu-west-1',
+            ec2=StubEC2(),
+            ssm_client=ssm_client,
+            ssm_rule_sets=[{'Tags': {'Service': 'web'}}],
+            filters={},
+            cache_key='test',
+        )
+
+        # Only instances matching the rules are requested, in batches.
+        self.assertEqual([len(instance_ids) for instance_ids in ssm_client.requests], [50, 10])
+
+        # SSM information is added to the matching instances, and they
+        # are marked as looked up even if they are not registered with SSM.
+        for instance in instances:
+            if instance['InstanceId'] == 'i-1':
+                self.assertNotIn('PingStatus', instance)
+                self.assertTrue(instance[ec2.ssm.looked_up_field])
+            elif instance['Tags']['Service'] == 'web':
+                self.assertEqual(instance['PingStatus'], 'Online')
+                self.assertTrue(instance[ec2.ssm.looked_up_field])
+            else:
+                self.assertNotIn('PingStatus', instance)
+                self.assertNotIn(ec2.ssm.looked_up_field, instance)
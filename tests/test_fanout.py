@@ -0,0 +1,41 @@
+import io
+import sys
+import unittest
+
+from ssha import fanout
+
+
+class TestFanout(unittest.TestCase):
+
+    def test_run(self):
+        commands = [
+            ('i-1', 'echo one; echo two'),
+            ('i-22', 'echo failed >&2; exit 3'),
+            ('i-3', 'read line; echo "stdin:$line"'),
+        ]
+
+        stdout = sys.stdout
+        sys.stdout = output = io.StringIO()
+        try:
+            results = fanout.run(commands, max_workers=2)
+        finally:
+            sys.stdout = stdout
+
+        self.assertEqual([exit_code for exit_code, _ in results], [0, 3, 0])
+
+        lines = output.getvalue().splitlines()
+
+        # Output is prefixed with the name and kept in order for each command.
+        prefixed = [line for line in lines if line.startswith('[i-')]
+        self.assertEqual([line for line in prefixed if line.startswith('[i-1]')], ['[i-1] one', '[i-1] two'])
+        self.assertIn('[i-22] failed', prefixed)
+        self.assertIn('[i-3] stdin:', prefixed)
+
+        # The summary has the exit code of each command, in the original order.
+        summary = lines[lines.index('[ssha] summary:') + 1:]
+        self.assertEqual([line.split()[:3] for line in summary[:3]], [
+            ['i-1', 'exit', '0'],
+            ['i-22', 'exit', '3'],
+            ['i-3', 'exit', '0'],
+        ])
+        self.assertEqual(summary[3], '[ssha] 2 succeeded, 1 failed')
@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from botocore.credentials import Credentials
+
+from ssha import aws, cache, config, iam, settings
+
+
+class StubIAM(object):
+    """
+    Returns a user with groups over two pages of results.
+
+    """
+
+    def __init__(self, groups):
+        self.groups = groups
+        self.calls = 0
+
+    def get_user(self):
+        self.calls += 1
+        return {'User': {'UserName': 'alice'}}
+
+    def list_groups_for_user(self, UserName, Marker=None):
+        self.calls += 1
+        response = {'ResponseMetadata': {'HTTPStatusCode': 200}}
+        if Marker:
+            response['Groups'] = [{'GroupName': name} for name in self.groups[1:]]
+        else:
+            response['Groups'] = [{'GroupName': name} for name in self.groups[:1]]
+            response['Marker'] = 'page-2'
+        return response
+
+
+class TestIAM(unittest.TestCase):
+
+    def setUp(self):
+        # Reset the global settings and config objects before each test,
+        # use a temporary directory for the cache files, and replace the
+        # AWS credentials and client with stubs.
+        settings.reset()
+        config.reset()
+        iam._cache.clear()
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = self.temp_dir
+        self.credentials = aws.credentials
+        self.client = aws.client
+        aws.credentials = lambda: Credentials('AKIAEXAMPLE', 'secret', method='shared-credentials-file')
+        self.stub = StubIAM(['admins', 'developers'])
+        aws.client = lambda service_name: self.stub
+
+    def tearDown(self):
+        aws.credentials = self.credentials
+        aws.client = self.client
+        iam._cache.clear()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.temp_dir)
+
+    def test_groups_cached(self):
+        self.assertEqual(iam.groups(), ['admins', 'developers'])
+        self.assertEqual(iam.user(), 'alice')
+        self.assertEqual(self.stub.calls, 3)
+
+        # The next run uses the groups cached on disk.
+        iam._cache.clear()
+        self.assertEqual(iam.groups(), ['admins', 'developers'])
+        self.assertEqual(self.stub.calls, 3)
+
+    def test_groups_stale(self):
+        config.add('iam.cache_ttl', 60)
+        cache_key = cache.key('AKIAEXAMPLE')
+        cache.write('iam', cache_key, {'user': 'alice', 'groups': ['admins']})
+
+        # A file left by a refresh that was stopped while writing.
+        temp_path = os.path.join(cache.directory(), 'iam', 'stopped.tmp')
+        with open(temp_path, 'w') as open_file:
+            open_file.write('{')
+        os.utime(temp_path, (0, 0))
+
+        # Make the cached groups look old.
+        real_time = time.time
+        time.time = lambda: real_time() + 120
+        try:
+            self.assertEqual(iam.groups(), ['admins'])
+        finally:
+            time.time = real_time
+
+        # The refresh updates the cache for the next run.
+        for _ in range(100):
+            if cache.read('iam', cache_key)[0]['groups'] != ['admins']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(cache.read('iam', cache_key)[0]['groups'], ['admins', 'developers'])
+        self.assertFalse(os.path.exists(temp_path))
+
+    def test_groups_assumed_role(self):
+        from botocore.credentials import AssumeRoleProvider
+        aws.credentials = lambda: Credentials('ASIAEXAMPLE', 'secret', method=AssumeRoleProvider.METHOD)
+        self.assertEqual(iam.groups(), [])
+        self.assertEqual(iam.user(), None)
+        self.assertEqual(self.stub.calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
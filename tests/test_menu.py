@@ -0,0 +1,161 @@
+import unittest
+
+from ssha import menu
+
+
+def labels(items):
+    return [item.label for item in items]
+
+
+class TestMenu(unittest.TestCase):
+
+    def test_search(self):
+        items = [menu.Item(label=label, value=index) for index, label in enumerate([
+            'i-0001  prod-web-1',
+            'i-0002  prod-worker-1',
+            'i-0003  stage-web-1',
+            'i-0004  webserver',
+            'i-0005  Prod-DB',
+        ])]
+        search = menu.Search(items)
+
+        self.assertEqual(labels(search.filter('')), labels(items))
+
+        # Matches are case-insensitive, with matches at the
+        # start of a word first, then inside words, then
+        # characters in order, closest together first.
+        self.assertEqual(labels(search.filter('web')), [
+            'i-0001  prod-web-1',
+            'i-0003  stage-web-1',
+            'i-0004  webserver',
+        ])
+        self.assertEqual(labels(search.filter('prod')), [
+            'i-0001  prod-web-1',
+            'i-0002  prod-worker-1',
+            'i-0005  Prod-DB',
+        ])
+        self.assertEqual(labels(search.filter('pw1')), [
+            'i-0001  prod-web-1',
+            'i-0002  prod-worker-1',
+        ])
+        self.assertEqual(labels(search.filter('erv')), [
+            'i-0004  webserver',
+        ])
+
+        # Typing more characters narrows the previous results,
+        # and deleting them reuses the earlier results.
+        search.filter('p')
+        search.filter('pr')
+        self.assertEqual([result[0] for result in search.results], ['', 'p', 'pr'])
+        self.assertEqual(labels(search.filter('p')), labels(search.filter('P')))
+        self.assertEqual([result[0] for result in search.results], ['', 'p'])
+        self.assertEqual(search.filter('zzz'), [])
+
+
+class StubWindow(object):
+    """
+    Records the strings displayed on a screen.
+
+    """
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self.calls = []
+
+    def addstr(self, y, x, string, attr):
+        self.calls.append((y, x, string, attr))
+
+    def clear(self):
+        pass
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def keypad(self, flag):
+        pass
+
+    def refresh(self):
+        pass
+
+    def subwin(self, y, x):
+        return self
+
+
+class StubPanel(object):
+
+    def hide(self):
+        pass
+
+    @classmethod
+    def new_panel(cls, window):
+        return cls()
+
+    @staticmethod
+    def update_panels():
+        pass
+
+
+class TestMenuDisplay(unittest.TestCase):
+
+    def setUp(self):
+        self.panel = menu.panel
+        menu.panel = StubPanel
+
+    def tearDown(self):
+        menu.panel = self.panel
+
+    def displayed_rows(self, window):
+        rows = set(y for y, x, string, attr in window.calls)
+        window.calls = []
+        return sorted(rows)
+
+    def test_draw(self):
+        items = [menu.Item(label='item-{}'.format(index), value=index) for index in range(1000)]
+        window = StubWindow(height=12, width=40)
+        instance_menu = menu.Menu(None, items, window)
+
+        # Only the visible items are displayed, between
+        # the blank top line and the bottom line.
+        instance_menu.draw()
+        self.assertEqual(self.displayed_rows(window), list(range(1, 12)))
+        self.assertEqual(instance_menu.page_height(), 10)
+        self.assertEqual(instance_menu.lines[1][0].strip(), 'item-0')
+        self.assertEqual(instance_menu.lines[10][0].strip(), 'item-9')
+
+        # Nothing is displayed again if nothing changed.
+        instance_menu.draw()
+        self.assertEqual(self.displayed_rows(window), [])
+
+        # Moving the selection displays the two changed lines.
+        instance_menu.navigate(1)
+        instance_menu.draw()
+        self.assertEqual(self.displayed_rows(window), [1, 2])
+
+        # Moving past the bottom scrolls by one line.
+        instance_menu.move_to(10)
+        instance_menu.draw()
+        self.assertEqual(instance_menu.top, 1)
+        self.assertEqual(instance_menu.lines[10][0].strip(), 'item-10')
+
+        # Paging stops at the last item.
+        instance_menu.move_to(instance_menu.position + 10000)
+        instance_menu.draw()
+        self.assertEqual(instance_menu.position, 999)
+        self.assertEqual(instance_menu.top, 990)
+
+        # Searching shows the best matches first, and blanks the other lines.
+        instance_menu.filter('item-99')
+        instance_menu.draw()
+        labels = [instance_menu.lines[y][0].strip() for y in range(1, 12)]
+        self.assertEqual(labels, [
+            'item-99', 'item-990', 'item-991', 'item-992', 'item-993', 'item-994',
+            'item-995', 'item-996', 'item-997', 'item-998', '/item-99  (28 of 1000)',
+        ])
+        instance_menu.filter('item-999')
+        instance_menu.draw()
+        self.assertEqual(instance_menu.lines[2][0].strip(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,124 @@
+import os
+import shutil
+import socket
+import stat
+import tempfile
 import unittest
 
+from ssha import config, settings, ssh
 from ssha.ssh import format_command
 
 
 class TestSSH(unittest.TestCase):
 
+    def setUp(self):
+        # Reset the global settings and config objects before each test,
+        # and use a temporary directory for control sockets.
+        settings.reset()
+        config.reset()
+        ssh._runtime.clear()
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_RUNTIME_DIR'] = self.temp_dir
+
+    def tearDown(self):
+        ssh._runtime.clear()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.temp_dir)
+
     def test_format_command(self):
         cmd = ('ssh', '-o', 'hello hello', 'localhost')
         result = format_command(cmd)
         self.assertEqual(result, 'ssh -o "hello hello" localhost')
+
+    def test_check(self):
+        prepare = ssh.prepare
+        popen = ssh.subprocess.Popen
+        commands = []
+        test = self
+
+        class StubPopen(object):
+            def __init__(self, command, **kwargs):
+                commands.append(command)
+                self.returncode = test.returncode
+
+            def communicate(self):
+                return None, test.error_output
+
+        ssh.prepare = lambda instance, bastion: ['ssh', '-o', 'Port=22', '10.0.0.1']
+        ssh.subprocess.Popen = StubPopen
+        try:
+            # Only a failure to connect or log in counts,
+            # and ssh never prompts for anything.
+            self.error_output = b''
+            self.returncode = 0
+            self.assertTrue(ssh.check({}, None))
+            self.returncode = 1
+            self.assertTrue(ssh.check({}, None))
+            self.returncode = ssh.connection_error_exit_code
+            self.error_output = b'Permission denied (publickey).\r\n'
+            self.assertFalse(ssh.check({}, None))
+
+            # An unknown host key is accepted when connecting.
+            self.error_output = b'Host key verification failed.\r\n'
+            self.assertTrue(ssh.check({}, None))
+        finally:
+            ssh.prepare = prepare
+            ssh.subprocess.Popen = popen
+
+        self.assertEqual(commands[0], [
+            'ssh', '-o', 'Port=22',
+            '-o', 'BatchMode=yes',
+            '-o', 'ConnectTimeout=10',
+            '10.0.0.1', 'true',
+        ])
+
+    def test_control_options(self):
+        self.assertEqual(ssh.control_options(), [])
+
+        config.add('ssh.multiplex', True)
+        directory = os.path.join(self.temp_dir, 'ssha')
+        self.assertEqual(ssh.control_options(), [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath={}/%C'.format(directory),
+            '-o', 'ControlPersist=10m',
+        ])
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o700)
+
+        # Tokens are escaped for use in a ProxyCommand.
+        config.add('ssh.control_persist', 60)
+        self.assertEqual(ssh.control_options(proxy_command=True)[3::2], [
+            'ControlPath={}/%%C'.format(directory),
+            'ControlPersist=60',
+        ])
+
+    def test_control_directory_permissions(self):
+        os.mkdir(os.path.join(self.temp_dir, 'ssha'), 0o755)
+        os.chmod(os.path.join(self.temp_dir, 'ssha'), 0o755)
+        config.add('ssh.multiplex', True)
+        self.assertRaises(SystemExit, ssh.control_options)
+
+    def test_clean_control_sockets(self):
+        live_path = os.path.join(self.temp_dir, 'live')
+        dead_path = os.path.join(self.temp_dir, 'dead')
+        other_path = os.path.join(self.temp_dir, 'other')
+
+        live = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        live.bind(live_path)
+        live.listen(1)
+
+        dead = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        dead.bind(dead_path)
+        dead.close()
+
+        open(other_path, 'w').close()
+
+        try:
+            ssh._clean_control_sockets(self.temp_dir)
+        finally:
+            live.close()
+
+        self.assertTrue(os.path.exists(live_path))
+        self.assertFalse(os.path.exists(dead_path))
+        self.assertTrue(os.path.exists(other_path))
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from ssha import config, settings, ssh_config
+
+
+CONFIG = '''
+# Comment
+Include {include_dir}/*.conf
+
+Host web-1.dev.ssha
+  User web
+  IdentityFile ~/.ssh/web
+
+Host *.dev.ssha !db-*.dev.ssha
+  User developer
+  IdentityFile=~/.ssh/%u-%h
+  Port 2222
+
+Match host "*.prod.ssha,*.stage.ssha"
+  User operator
+
+Match exec "true"
+  User never
+
+Host *
+  User default
+  IdentityFile ~/.ssh/id_rsa
+'''
+
+INCLUDED = '''
+Host db-*.dev.ssha
+  User dba
+
+Host *.ssha !*.dev.ssha
+  Port 22
+'''
+
+
+class TestSSHConfig(unittest.TestCase):
+
+    def setUp(self):
+        # Reset the global settings and config objects before each test,
+        # and use a temporary directory for the config and cache files.
+        settings.reset()
+        config.reset()
+        self.temp_dir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(self.temp_dir, 'cache')
+        os.environ['USER'] = 'me'
+
+        self.include_dir = os.path.join(self.temp_dir, 'config.d')
+        os.mkdir(self.include_dir)
+        with open(os.path.join(self.include_dir, 'db.conf'), 'w') as open_file:
+            open_file.write(INCLUDED)
+
+        self.path = os.path.join(self.temp_dir, 'config')
+        with open(self.path, 'w') as open_file:
+            open_file.write(CONFIG.format(include_dir=self.include_dir))
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.temp_dir)
+
+    def test_lookup(self):
+        parsed = ssh_config.load(self.path)
+
+        # The first value found is used, and identity files are combined.
+        result = parsed.lookup('web-1.dev.ssha')
+        self.assertEqual(result['user'], 'web')
+        self.assertEqual(result['port'], '2222')
+        self.assertEqual(result['identityfile'], [
+            '~/.ssh/web',
+            '~/.ssh/me-web-1.dev.ssha',
+            '~/.ssh/id_rsa',
+        ])
+
+        # Included files are used in the position of the Include directive.
+        self.assertEqual(parsed.lookup('db-1.dev.ssha')['user'], 'dba')
+        self.assertEqual(parsed.lookup('web.prod.ssha')['port'], '22')
+
+        # Negated patterns exclude hosts.
+        self.assertNotIn('port', parsed.lookup('db-1.dev.ssha'))
+
+        # Supported Match criteria are used, and others are ignored.
+        self.assertEqual(parsed.lookup('web.prod.ssha')['user'], 'operator')
+        self.assertEqual(parsed.lookup('other')['user'], 'default')
+        self.assertEqual(parsed.lookup('other')['hostname'], 'other')
+
+    def test_include_in_host(self):
+        included_path = os.path.join(self.include_dir, 'user.conf')
+        with open(included_path, 'w') as open_file:
+            open_file.write('User included\n')
+        with open(self.path, 'w') as open_file:
+            open_file.write('Host *.dev.ssha\n  Include {}\n  Port 22\n'.format(included_path))
+
+        parsed = ssh_config.load(self.path)
+        self.assertEqual(parsed.lookup('web.dev.ssha'), {'user': 'included', 'port': '22', 'hostname': 'web.dev.ssha'})
+        self.assertEqual(parsed.lookup('web.prod.ssha'), {'hostname': 'web.prod.ssha'})
+
+    def test_cache(self):
+        ssh_config.load(self.path)
+
+        # Cached results are used when the files have not changed.
+        parse = ssh_config.parse
+        ssh_config.parse = None
+        try:
+            self.assertEqual(ssh_config.load(self.path).lookup('web-1.dev.ssha')['user'], 'web')
+        finally:
+            ssh_config.parse = parse
+
+        # Changes to included files are noticed.
+        included_path = os.path.join(self.include_dir, 'db.conf')
+        with open(included_path, 'w') as open_file:
+            open_file.write('User changed\n')
+        mtime = time.time() + 10
+        os.utime(included_path, (mtime, mtime))
+        self.assertEqual(ssh_config.load(self.path).lookup('other')['user'], 'changed')
+
+        # Files added to included directories are noticed.
+        with open(os.path.join(self.include_dir, 'a.conf'), 'w') as open_file:
+            open_file.write('User added\n')
+        os.utime(self.include_dir, (mtime + 10, mtime + 10))
+        self.assertEqual(ssh_config.load(self.path).lookup('other')['user'], 'added')
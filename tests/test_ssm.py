@@ -0,0 +1,259 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from ssha import config, settings, ssm
+
+
+class StubSSM(object):
+    """
+    Returns command invocations that finish after a number of calls.
+
+    """
+
+    def __init__(self, finished_after, error_codes=()):
+        self.finished_after = finished_after
+        self.error_codes = list(error_codes)
+        self.calls = 0
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, CommandId, Details):
+        self.calls += 1
+        if self.error_codes:
+            from botocore.exceptions import ClientError
+            error_code = self.error_codes.pop(0)
+            raise ClientError({'Error': {'Code': error_code}}, 'ListCommandInvocations')
+        invocations = []
+        for instance_id, calls in sorted(self.finished_after.items()):
+            if self.calls >= calls:
+                status = 'Success'
+            else:
+                status = 'InProgress'
+            invocations.append({'InstanceId': instance_id, 'Status': status})
+        yield {'CommandInvocations': invocations}
+
+
+class StubBatchSSM(object):
+    """
+    Runs commands that finish straight away, printing host keys.
+
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.list_calls = 0
+        self.get_calls = 0
+
+    def output(self, instance_id):
+        return 'localhost ssh-ed25519 {}\n'.format(instance_id)
+
+    def get_command_invocation(self, CommandId, InstanceId):
+        assert InstanceId in self.commands[CommandId]
+        self.get_calls += 1
+        return {'StandardOutputContent': self.output(InstanceId)}
+
+    def get_paginator(self, operation_name):
+        return self
+
+    def paginate(self, CommandId, Details):
+        self.list_calls += 1
+        invocations = []
+        for instance_id in self.commands[CommandId]:
+            invocation = {'InstanceId': instance_id, 'Status': 'Success'}
+            if Details:
+                output = self.output(instance_id)
+                if instance_id == 'i-bastion':
+                    # Long output is truncated in the listing.
+                    output = output[:10] + '\n\n---Output truncated---'
+                invocation['CommandPlugins'] = [{'Name': 'runShellScript', 'Output': output}]
+            invocations.append(invocation)
+        yield {'CommandInvocations': invocations}
+
+    def send_command(self, InstanceIds, DocumentName, Parameters):
+        command_id = 'command-{}'.format(len(self.commands))
+        self.commands[command_id] = InstanceIds
+        return {'Command': {'CommandId': command_id}}
+
+
+class TestSSM(unittest.TestCase):
+
+    def setUp(self):
+        # Reset the global settings and config objects before each test,
+        # and replace the SSM client and sleeping with stubs.
+        settings.reset()
+        config.reset()
+        self.client = ssm.aws.client
+        self.sleep = ssm.time.sleep
+        self.sleeps = []
+        ssm.time.sleep = self.sleeps.append
+
+    def tearDown(self):
+        ssm.aws.client = self.client
+        ssm.time.sleep = self.sleep
+
+    def test_wait_for_command(self):
+        client = StubSSM({'i-bastion': 3, 'i-target': 2})
+        ssm.aws.client = lambda service_name: client
+
+        ssm._wait_for_command({'command-id': ['i-target', 'i-bastion']})
+
+        # Both instances are checked together, with increasing delays.
+        self.assertEqual(client.calls, 3)
+        self.assertEqual(len(self.sleeps), 3)
+        self.assertLess(self.sleeps[0], self.sleeps[2])
+
+    def test_wait_for_command_errors(self):
+        client = StubSSM({'i-target': 1}, error_codes=['InvalidCommandId', 'ThrottlingException'])
+        ssm.aws.client = lambda service_name: client
+
+        # New commands might not be found yet, and throttling is retried.
+        ssm._wait_for_command({'command-id': ['i-target']})
+        self.assertEqual(client.calls, 3)
+
+        # Other errors, such as missing permissions, are raised straight away.
+        from botocore.exceptions import ClientError
+        client = StubSSM({'i-target': 1}, error_codes=['AccessDeniedException'])
+        ssm.aws.client = lambda service_name: client
+        with self.assertRaises(ClientError):
+            ssm._wait_for_command({'command-id': ['i-target']})
+        self.assertEqual(client.calls, 1)
+
+    def test_send_commands(self):
+        client = StubBatchSSM()
+        ssm.aws.client = lambda service_name: client
+
+        temp_dir = tempfile.mkdtemp()
+        host_keys_file = os.path.join(temp_dir, 'known_hosts')
+        config.add('ssm.document.name', 'add-ssh-key')
+        config.add('ssm.host_keys_file', host_keys_file)
+
+        bastion = {'InstanceId': 'i-bastion', 'PublicIpAddress': '1.1.1.1', 'PrivateIpAddress': '10.0.1.1'}
+        connections = []
+        for index in range(120):
+            instance = {'InstanceId': 'i-{:03d}'.format(index), 'PrivateIpAddress': '10.0.0.{}'.format(index)}
+            connections.append((instance, bastion))
+
+        try:
+            ssm.send_commands(connections)
+            with open(host_keys_file) as open_file:
+                host_keys = open_file.read().splitlines()
+        finally:
+            shutil.rmtree(temp_dir)
+
+        # The bastion only gets the command once, and the instances
+        # are sent the command in batches that are waited on together.
+        self.assertEqual([len(instance_ids) for instance_ids in client.commands.values()], [50, 50, 21])
+        self.assertEqual(client.list_calls, 3)
+        self.assertEqual(len(self.sleeps), 1)
+
+        # The output is listed while waiting, and is only
+        # fetched separately when it was truncated.
+        self.assertEqual(client.get_calls, 1)
+
+        # Host keys for every instance are in one file, using the addresses ssh will use.
+        self.assertEqual(len(host_keys), 121)
+        self.assertIn('10.0.0.7 ssh-ed25519 i-007', host_keys)
+        self.assertIn('1.1.1.1 ssh-ed25519 i-bastion', host_keys)
+
+    def test_send_commands_provisioned(self):
+        client = StubBatchSSM()
+        ssm.aws.client = lambda service_name: client
+
+        temp_dir = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(temp_dir, 'cache')
+        host_keys_file = os.path.join(temp_dir, 'known_hosts')
+
+        config.add('aws.region_name', 'eu-west-1')
+        config.add('ssm.document.name', 'add-ssh-key')
+        config.add('ssm.host_keys_file', host_keys_file)
+        config.add('ssm.parameters', {'key': ['one']})
+        config.add('ssm.provision_ttl', 600)
+
+        instance = {'InstanceId': 'i-1', 'PrivateIpAddress': '10.0.0.1'}
+
+        try:
+            self.assertEqual(ssm.send_command(instance, None), [])
+            self.assertEqual(len(client.commands), 1)
+
+            # Recently provisioned instances are skipped,
+            # and their saved host keys are used.
+            os.remove(host_keys_file)
+            self.assertEqual(ssm.send_command(instance, None), ['i-1'])
+            self.assertEqual(len(client.commands), 1)
+            with open(host_keys_file) as open_file:
+                self.assertEqual(open_file.read(), '10.0.0.1 ssh-ed25519 i-1\n')
+
+            # Changing the parameters runs the document again.
+            config.add('ssm.parameters', {'key': ['two']})
+            self.assertEqual(ssm.send_command(instance, None), [])
+            self.assertEqual(len(client.commands), 2)
+
+            # Forgotten instances are provisioned again.
+            ssm.forget_provisioned(['i-1'])
+            self.assertEqual(ssm.send_command(instance, None), [])
+            self.assertEqual(len(client.commands), 3)
+
+            # Nothing is skipped without a validity window.
+            config.add('ssm.provision_ttl', 0)
+            self.assertEqual(ssm.send_command(instance, None), [])
+            self.assertEqual(len(client.commands), 4)
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(temp_dir)
+
+    def test_wait_for_command_timeout(self):
+        client = StubSSM({'i-target': 100})
+        ssm.aws.client = lambda service_name: client
+        config.add('ssm.timeout', 1)
+
+        times = iter(range(0, 100))
+        time = ssm.time.time
+        ssm.time.time = lambda: next(times)
+        try:
+            with self.assertRaises(SystemExit):
+                ssm._wait_for_command({'command-id': ['i-target']})
+        finally:
+            ssm.time.time = time
+
+        self.assertEqual(client.calls, 1)
+
+    def test_session_manager_enabled(self):
+        temp_dir = tempfile.mkdtemp()
+        environ = dict(os.environ)
+        os.environ['XDG_CACHE_HOME'] = os.path.join(temp_dir, 'cache')
+        os.environ['PATH'] = os.path.join(temp_dir, 'bin')
+        try:
+            config.add('ssm.session_manager', True)
+
+            # SSM information from discovery is used without any API calls.
+            ssm.aws.client = None
+            instance = {'InstanceId': 'i-target', 'PingStatus': 'Online', 'AgentVersion': '3.0'}
+            self.assertFalse(ssm.session_manager_enabled(instance))
+
+            # The plugin is found in the PATH and remembered.
+            plugin_path = os.path.join(temp_dir, 'bin', 'session-manager-plugin')
+            os.mkdir(os.path.dirname(plugin_path))
+            with open(plugin_path, 'w'):
+                pass
+            os.chmod(plugin_path, 0o755)
+            self.assertTrue(ssm.session_manager_enabled(instance))
+            os.environ['PATH'] = os.path.join(temp_dir, 'bin') + os.pathsep + os.path.join(temp_dir, 'other')
+            self.assertEqual(ssm._find_executable('session-manager-plugin'), plugin_path)
+
+            # Instances without an agent can't use Session Manager.
+            self.assertFalse(ssm.session_manager_enabled({'InstanceId': 'i-target', 'AgentVersion': ''}))
+
+            # Instances that discovery checked, but that are not registered
+            # with SSM, are not looked up again.
+            instance = {'InstanceId': 'i-target', ssm.looked_up_field: True}
+            self.assertTrue(ssm.session_manager_enabled(instance))
+
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            shutil.rmtree(temp_dir)
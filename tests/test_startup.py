@@ -0,0 +1,40 @@
+import subprocess
+import sys
+import unittest
+
+
+# Modules that are slow to import, and must only be imported
+# by the code paths that use them.
+HEAVY_MODULES = (
+    'boto3',
+    'boto_source_profile_mfa',
+    'botocore',
+    'cryptography',
+    'distutils',
+    'hcl',
+    'paramiko',
+)
+
+
+def imported_modules(code):
+    """
+    Runs code in a new Python process and
+    returns the heavy modules that it imported.
+
+    """
+    script = code + '\nimport sys\nprint("imported:", *sorted(m for m in {} if m in sys.modules))'.format(
+        HEAVY_MODULES,
+    )
+    output = subprocess.check_output([sys.executable, '-c', 'from __future__ import print_function\n' + script])
+    last_line = output.decode('utf-8').splitlines()[-1]
+    return last_line.split()[1:]
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_import(self):
+        self.assertEqual(imported_modules('import ssha.cli'), [])
+
+    def test_version(self):
+        code = 'import sys\nfrom ssha.cli import main\nsys.argv = ["ssha", "--version"]\nmain()'
+        self.assertEqual(imported_modules(code), [])
@@ -0,0 +1,66 @@
+import io
+import sys
+import threading
+import time
+import unittest
+
+from ssha import tasks
+
+
+class TestTasks(unittest.TestCase):
+
+    def test_graph(self):
+        graph = tasks.Graph()
+        started = threading.Event()
+        order = []
+
+        def slow():
+            started.set()
+            time.sleep(0.05)
+            order.append('slow')
+            return 'slow result'
+
+        def after_slow():
+            order.append('after_slow')
+            return 'after_slow result'
+
+        graph.run('first', order.append, 'first')
+        graph.skip('unused', 'not needed')
+        graph.submit('slow', slow, deps=('first',))
+        graph.submit('after_slow', after_slow, deps=('slow',))
+
+        # The main thread keeps going while the slow task runs.
+        started.wait()
+        graph.run('main', order.append, 'main')
+
+        self.assertEqual(graph.result('after_slow'), 'after_slow result')
+        self.assertEqual(graph.result('slow'), 'slow result')
+        self.assertEqual(order, ['first', 'main', 'slow', 'after_slow'])
+        self.assertEqual(graph.critical_path(), ['first', 'slow', 'after_slow'])
+
+        # Errors are raised when getting the result.
+        graph.submit('failing', sys.exit, 'failed', deps=('slow',))
+        self.assertRaises(SystemExit, graph.result, 'failing')
+        self.assertRaises(ValueError, graph.submit, 'unknown', order.append, deps=('missing',))
+        graph.shutdown()
+
+        stdout = sys.stdout
+        sys.stdout = output = io.StringIO()
+        try:
+            graph.trace()
+        finally:
+            sys.stdout = stdout
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], '[ssha] trace:')
+        self.assertEqual(
+            [line.split()[0] for line in lines[1:-1]],
+            ['first', 'unused', 'slow', 'after_slow', 'main', 'failing'],
+        )
+        self.assertEqual(lines[2].split(None, 1)[1], 'skipped (not needed)')
+        self.assertIn('after slow', lines[4])
+        self.assertTrue(lines[-1].startswith('  critical path: first -> slow -> failing'))
+
+
+if __name__ == '__main__':
+    unittest.main()